@@ -3,37 +3,126 @@ import pandas as pd
 import requests
 import os
 import json
+import time
 import plotly.express as px
 from datetime import datetime
 
+from smartdash.frames import to_frames, merge_frames, get_dash_charts
+
 SERVER_URL = os.getenv("SMARTDASH_SERVER_URL")
 
 if not SERVER_URL:
     print("--server_url is required for --dash")
     quit()
 
+# fetched data is reused for this many seconds, eg: while filters are changed
+REFRESH_TTL = float(os.getenv("SMARTDASH_REFRESH_TTL", 10))
+LOGS_PAGE_SIZE = int(os.getenv("SMARTDASH_LOGS_PAGE_SIZE", 500))
+# above MAX_SERIES uids, charts are drawn from at most MAX_POINTS time buckets instead of one trace per uid
+MAX_SERIES = int(os.getenv("SMARTDASH_MAX_SERIES", 50))
+MAX_POINTS = int(os.getenv("SMARTDASH_MAX_POINTS", 500))
+
 
 # Function to fetch data
 def fetch_dash_data(app_name, last_n_hours, long_running_n_hours=1):
-    data = requests.get(
-        f"{SERVER_URL}/get_dash_metrics?app_name={app_name}&last_n_hours={last_n_hours}&long_running_n_hours={long_running_n_hours}"
+    # data is cached per (app, window) in the session, after REFRESH_TTL only uids updated since
+    # the cursor returned by the server are fetched again
+    cache_key = f"dash_data:{app_name}:{last_n_hours}:{long_running_n_hours}"
+    cached = st.session_state.get(cache_key)
+    now = time.time()
+
+    if cached and now - cached["fetched_at"] < REFRESH_TTL:
+        return cached["frames"]
+
+    url = f"{SERVER_URL}/get_dash_metrics?app_name={app_name}&last_n_hours={last_n_hours}&long_running_n_hours={long_running_n_hours}&format=columns"
+    if cached:
+        url += f"&since_cursor={cached['cursor']}"
+
+    data = requests.get(url).json()
+    frames = to_frames(data["columns"])
+
+    if cached:
+        frames = merge_frames(
+            cached["frames"],
+            frames,
+            since=now - last_n_hours * 3600,
+            now=now,
+            long_running_n_hours=long_running_n_hours,
+        )
+
+    st.session_state[cache_key] = {
+        "frames": frames,
+        "cursor": data["cursor"],
+        "fetched_at": now,
+    }
+
+    return frames
+
+
+def fetch_logs(app_name, last_n_hours, tags, level, stage, u_id, cursor=None):
+    params = {
+        "app_name": app_name,
+        "last_n_hours": last_n_hours,
+        "limit": LOGS_PAGE_SIZE,
+        "tags": tags,
+    }
+    for key, value in (
+        ("level", level),
+        ("stage", stage),
+        ("u_id", u_id),
+        ("cursor", cursor),
+    ):
+        if value:
+            params[key] = value
+
+    return requests.get(f"{SERVER_URL}/get_logs", params=params).json()
+
+
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_app_names():
+    return requests.get(f"{SERVER_URL}/app_names").json()["app_names"]
+
+
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_dash_rollups(app_name, last_n_hours):
+    return requests.get(
+        f"{SERVER_URL}/get_dash_rollups?app_name={app_name}&last_n_hours={last_n_hours}"
     ).json()
 
-    return data["data_by_uid"]
+
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_catalog(app_name, last_n_hours):
+    return requests.get(
+        f"{SERVER_URL}/get_catalog?app_name={app_name}&last_n_hours={last_n_hours}"
+    ).json()
+
+
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_dash_series(app_name, last_n_hours):
+    return requests.get(
+        f"{SERVER_URL}/get_dash_series?app_name={app_name}&last_n_hours={last_n_hours}&max_points={MAX_POINTS}&max_series={MAX_SERIES}"
+    ).json()
 
 
-def get_all_tags_levels_stages(data_by_uid):
-    tags = set()
-    levels = set()
-    stages = set()
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_metrics(app_name, last_n_hours):
+    return requests.get(
+        f"{SERVER_URL}/get_metrics?app_name={app_name}&last_n_hours={last_n_hours}&max_points={MAX_POINTS}"
+    ).json()
 
-    for uid, data in data_by_uid.items():
-        for log in data["logs"]:
-            tags.update(log["tags"])
-            levels.add(log["level"])
-            stages.add(log["stage"])
 
-    return sorted(tags), sorted(levels), sorted(stages)
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_exception_groups(app_name, last_n_hours):
+    return requests.get(
+        f"{SERVER_URL}/get_exception_groups?app_name={app_name}&last_n_hours={last_n_hours}"
+    ).json()["exception_groups"]
+
+
+@st.cache_data(ttl=REFRESH_TTL)
+def fetch_stage_percentiles(app_name, last_n_hours):
+    return requests.get(
+        f"{SERVER_URL}/get_stage_percentiles?app_name={app_name}&last_n_hours={last_n_hours}"
+    ).json()["percentiles"]
 
 
 # Main function to run the Streamlit app
@@ -54,7 +143,7 @@ def main():
         st.sidebar.markdown("## Settings")
         app_name = st.sidebar.selectbox(
             "Select App",
-            requests.get(f"{SERVER_URL}/app_names").json()["app_names"],
+            fetch_app_names(),
             index=0,
         )
         time_range = st.sidebar.selectbox(
@@ -81,9 +170,16 @@ def main():
         long_running_n_hours = time_mapping[long_running_range]
         last_n_hours = time_mapping[time_range]
 
-        data_by_uid = fetch_dash_data(app_name, last_n_hours, long_running_n_hours)
+        frames = fetch_dash_data(app_name, last_n_hours, long_running_n_hours)
+        charts = get_dash_charts(frames)
 
-        all_tags, all_levels, all_stages = get_all_tags_levels_stages(data_by_uid)
+        # dropdown options come from the server catalog of tags, levels and stages
+        catalog = fetch_catalog(app_name, last_n_hours)
+        all_tags, all_levels, all_stages = (
+            catalog["tags"],
+            catalog["levels"],
+            catalog["stages"],
+        )
 
         # Add filters in the sidebar
         st.sidebar.markdown("## Filter Logs")
@@ -94,36 +190,11 @@ def main():
 
         graphs = []
 
-        # Calculate total time per unique ID
-        total_times = {}
-        logger_metric_name_wise_values = {}
-        for uid, data in data_by_uid.items():
-            if data["logs"]:
-                first_log_time = data["logs"][0]["timestamp"]
-                last_log_time = data["logs"][-1]["timestamp"]
-                total_times[uid] = last_log_time - first_log_time
-
-            if data["metrics"]:
-                for metric in data["metrics"]:
-                    if metric["metric"] not in logger_metric_name_wise_values:
-                        logger_metric_name_wise_values[metric["metric"]] = []
-                    logger_metric_name_wise_values[metric["metric"]].append(
-                        {
-                            "uid": uid,
-                            "value": metric["value"],
-                            "timestamp": metric["timestamp"],
-                            "stage": metric["stage"],
-                        }
-                    )
-
-        # Create a pie chart showing the distribution of times taken by each stage
-        stage_times = {}
-        for uid, data in data_by_uid.items():
-            for stage, times in data["stage_wise_times"].items():
-                if stage not in stage_times:
-                    stage_times[stage] = times["end"] - times["start"]
-                else:
-                    stage_times[stage] += times["end"] - times["start"]
+        # Create a pie chart showing the distribution of times taken by each stage, from the server rollups
+        rollups = fetch_dash_rollups(app_name, last_n_hours)
+        stage_times = {
+            stage: stats["sum"] for stage, stats in rollups["stage_stats"].items()
+        }
 
         if stage_times:
             stage_time_pie = px.pie(
@@ -133,24 +204,31 @@ def main():
             )
             graphs.append(stage_time_pie)
 
-        # Create a line chart showing the time taken by each stage with unique IDs on the x-axis and time taken on the y-axis
-        line_chart_data = []
-        for uid, data in data_by_uid.items():
-            for stage, times in data["stage_wise_times"].items():
-                line_chart_data.append(
-                    {
-                        "uid": uid,
-                        "stage": stage,
-                        "time_taken": times["end"] - times["start"],
-                    }
-                )
+        # Create a bar chart showing p50/p95/p99 latency of each stage
+        stage_percentiles = fetch_stage_percentiles(app_name, last_n_hours)
+        if stage_percentiles:
+            percentiles_df = pd.DataFrame(
+                [
+                    {"stage": stage, "percentile": percentile, "time_taken": value}
+                    for stage, percentiles in stage_percentiles.items()
+                    for percentile, value in percentiles.items()
+                ]
+            )
+            stage_percentiles_bar = px.bar(
+                percentiles_df,
+                x="stage",
+                y="time_taken",
+                color="percentile",
+                barmode="group",
+                title="Stage latency percentiles",
+            )
+            graphs.append(stage_percentiles_bar)
 
-        # Create a line chart showing logger_metric_name_wise_values with time stamp on the x-axis and value on the y-axis
-        if logger_metric_name_wise_values:
-            for metric_name, values in logger_metric_name_wise_values.items():
-                line_chart_df = pd.DataFrame(values)
+        if len(frames["uids"]) <= MAX_SERIES:
+            # Create a line chart showing each metric with time stamp on the x-axis and value on the y-axis
+            for metric_name, values in charts["metric_values"].items():
                 line_chart = px.line(
-                    line_chart_df,
+                    values,
                     x="timestamp",
                     y="value",
                     color="uid",
@@ -158,38 +236,69 @@ def main():
                 )
                 graphs.append(line_chart)
 
-        if line_chart_data:
-            line_chart_df = pd.DataFrame(line_chart_data)
-            stage_time_line = px.line(
-                line_chart_df,
-                x="uid",
-                y="time_taken",
-                color="stage",
-                title="Time taken by each stage",
-            )
-            graphs.append(stage_time_line)
-
-        if data_by_uid:
-            metrics_df = pd.DataFrame(
-                {
-                    "status": [
-                        "Success"
-                        if data["success"]
-                        else "In Process"
-                        if data["in_process"]
-                        else "Failed"
-                        if data["failed"]
-                        else "Long running"
-                        for uid, data in data_by_uid.items()
-                    ],
-                }
-            )
+            # Create a line chart showing the time taken by each stage with unique IDs on the x-axis and time taken on the y-axis
+            if not charts["stage_time_taken"].empty:
+                stage_time_line = px.line(
+                    charts["stage_time_taken"],
+                    x="uid",
+                    y="time_taken",
+                    color="stage",
+                    title="Time taken by each stage",
+                )
+                graphs.append(stage_time_line)
+        else:
+            # too many uids for one trace each, draw server side time buckets of mean/min/max instead
+            series = fetch_dash_series(app_name, last_n_hours)
+
+            metrics_df = pd.DataFrame(series["metrics"])
+            metrics_df["time"] = pd.to_datetime(metrics_df["time"], unit="s")
+            for metric_name, values in metrics_df.groupby("metric", sort=False):
+                line_chart = px.line(
+                    values,
+                    x="time",
+                    y=["mean", "min", "max"],
+                    title=f"{metric_name}",
+                )
+                graphs.append(line_chart)
 
+            stages_df = pd.DataFrame(series["stages"])
+            if not stages_df.empty:
+                stages_df["time"] = pd.to_datetime(stages_df["time"], unit="s")
+                stage_time_line = px.line(
+                    stages_df,
+                    x="time",
+                    y="mean",
+                    color="stage",
+                    hover_data=["count", "min", "max"],
+                    title=f"Mean time taken by each stage per {series['bucket_seconds'] // 60} min",
+                )
+                graphs.append(stage_time_line)
+
+        # counters, gauges and histograms summarized by the loggers, one chart per metric with a line per stage
+        metrics = fetch_metrics(app_name, last_n_hours)
+        app_metrics_df = pd.DataFrame(metrics["series"])
+        if not app_metrics_df.empty:
+            app_metrics_df["time"] = pd.to_datetime(app_metrics_df["time"], unit="s")
+            app_metrics_df["stage"] = app_metrics_df["stage"].fillna("-")
+            for (metric_type, metric_name), values in app_metrics_df.groupby(
+                ["metric_type", "metric"], sort=False
+            ):
+                line_chart = px.line(
+                    values,
+                    x="time",
+                    y="value",
+                    color="stage",
+                    hover_data=["count", "min", "max"],
+                    title=f"{metric_name} ({metric_type} per {metrics['bucket_seconds']}s)",
+                )
+                graphs.append(line_chart)
+
+        if not charts["status_counts"].empty:
             metrics_pie = px.pie(
-                metrics_df,
-                names="status",
+                values=charts["status_counts"].values,
+                names=charts["status_counts"].index,
                 title="Uids by Status",
-                color="status",
+                color=charts["status_counts"].index,
                 color_discrete_map={
                     "Success": "green",
                     "In Process": "yellow",
@@ -206,45 +315,64 @@ def main():
         for i, graph in enumerate(graphs):
             cols[i % 2].plotly_chart(graph)
 
+        if metrics["percentiles"]:
+            with st.expander("Histogram percentiles"):
+                st.dataframe(pd.DataFrame(metrics["percentiles"]))
+
+        exception_groups = fetch_exception_groups(app_name, last_n_hours)
+        if exception_groups:
+            with st.expander("Top exceptions"):
+                exceptions_df = pd.DataFrame(exception_groups)
+                for key in ("first_time", "last_time"):
+                    exceptions_df[key] = pd.to_datetime(exceptions_df[key], unit="s")
+                st.dataframe(exceptions_df.drop(columns=["traceback"]))
+
+                # each traceback is stored once per group, shown for the selected one
+                fingerprint = st.selectbox(
+                    "Traceback of", exceptions_df["fingerprint"], index=0
+                )
+                traceback = exceptions_df.loc[
+                    exceptions_df["fingerprint"] == fingerprint, "traceback"
+                ].iloc[0]
+                st.code(traceback or "traceback not received yet")
+
         with st.expander("Show/hide logs"):
-            logs_data = []
-            for uid, data in data_by_uid.items():
-                logs_data.extend(data["logs"])
-                if data["success"]:
-                    logs_data[-1]["status"] = "Success"
-                elif data["failed"]:
-                    logs_data[-1]["status"] = "Failed"
-                elif data["in_process"]:
-                    logs_data[-1]["status"] = "In Process"
-                elif data["long_running"]:
-                    logs_data[-1]["status"] = "Long running"
-                else:
-                    logs_data[-1]["status"] = "Unknown"
-
-            if logs_data:
+            # logs are filtered and paged on the server, only the current page is fetched
+            page_key = f"logs_page:{app_name}:{last_n_hours}:{filter_tags}:{filter_level}:{filter_stage}:{filter_uid}"
+            if page_key not in st.session_state:
+                st.session_state[page_key] = [None]
+            page_cursors = st.session_state[page_key]
+
+            logs_page = fetch_logs(
+                app_name,
+                last_n_hours,
+                tags=filter_tags,
+                level=filter_level if filter_level != "All" else None,
+                stage=filter_stage if filter_stage != "All" else None,
+                u_id=filter_uid,
+                cursor=page_cursors[-1],
+            )
+
+            if logs_page["logs"]:
+                # ids only make up the paging cursor
+                logs_df = pd.DataFrame(logs_page["logs"]).drop(columns=["id"])
                 # Convert timestamp to datetime format
-                for log in logs_data:
-                    log["timestamp"] = datetime.fromtimestamp(log["timestamp"])
-
-                # Apply filters
-                if filter_tags:
-                    logs_data = [
-                        log for log in logs_data if set(log["tags"]) & set(filter_tags)
-                    ]
-                if filter_level != "All":
-                    logs_data = [
-                        log for log in logs_data if log["level"] == filter_level
-                    ]
-                if filter_stage != "All":
-                    logs_data = [
-                        log for log in logs_data if log["stage"] == filter_stage
-                    ]
-                if filter_uid:
-                    logs_data = [log for log in logs_data if log["u_id"] == filter_uid]
-
-                logs_df = pd.DataFrame(logs_data)
+                logs_df["timestamp"] = [
+                    datetime.fromtimestamp(timestamp)
+                    for timestamp in logs_df["timestamp"]
+                ]
                 st.dataframe(logs_df)
 
+            prev_col, next_col = st.columns(2)
+            if prev_col.button("Newer logs", disabled=len(page_cursors) == 1):
+                page_cursors.pop()
+                st.rerun()
+            if next_col.button(
+                "Older logs", disabled=logs_page["next_cursor"] is None
+            ):
+                page_cursors.append(logs_page["next_cursor"])
+                st.rerun()
+
     except Exception as e:
         print(e)
         st.warning(
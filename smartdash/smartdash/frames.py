@@ -0,0 +1,140 @@
+import time
+import numpy as np
+import pandas as pd
+
+UID_COLUMNS = ["u_id", "start", "end", "success", "failed", "in_process", "long_running"]
+STAGE_COLUMNS = ["u_id", "stage", "start", "end"]
+METRIC_COLUMNS = ["u_id", "metric", "value", "timestamp", "stage"]
+
+
+def to_frames(columns):
+    return {
+        "uids": pd.DataFrame(columns["uids"], columns=UID_COLUMNS),
+        "stages": pd.DataFrame(columns["stages"], columns=STAGE_COLUMNS),
+        "metrics": pd.DataFrame(columns["metrics"], columns=METRIC_COLUMNS),
+    }
+
+
+def merge_frames(cached, updated, since, now, long_running_n_hours):
+    # rows of updated uids replace the cached ones, uids whose last log left the window are dropped
+    merged = {}
+    for name, frame in cached.items():
+        merged[name] = pd.concat(
+            [frame[~frame["u_id"].isin(updated["uids"]["u_id"])], updated[name]],
+            ignore_index=True,
+        )
+
+    # usually few or no uids left the window since the previous refresh, so rows are matched
+    # against the set of those instead of against every uid still in it
+    uids = merged["uids"]
+    left_window = uids["end"] < since
+    if left_window.any():
+        dropped = set(uids.loc[left_window, "u_id"])
+        merged = {
+            name: frame[~frame["u_id"].isin(dropped)].reset_index(drop=True)
+            for name, frame in merged.items()
+        }
+
+    # unfinished uids without new records become long running as time passes
+    uids = merged["uids"]
+    unfinished = ~uids["success"].astype(bool) & ~uids["failed"].astype(bool)
+    long_running = now - uids["start"] > long_running_n_hours * 3600
+    uids.loc[unfinished, "long_running"] = long_running[unfinished]
+    uids.loc[unfinished, "in_process"] = ~long_running[unfinished]
+
+    return merged
+
+
+def get_dash_charts(frames):
+    uids, stages, metrics = frames["uids"], frames["stages"], frames["metrics"]
+
+    status = pd.Series(
+        np.select(
+            [
+                uids["success"].astype(bool),
+                uids["in_process"].astype(bool),
+                uids["failed"].astype(bool),
+            ],
+            ["Success", "In Process", "Failed"],
+            default="Long running",
+        )
+    )
+
+    return {
+        "status_counts": status.value_counts(),
+        "stage_time_taken": pd.DataFrame(
+            {
+                "uid": stages["u_id"],
+                "stage": stages["stage"],
+                "time_taken": stages["end"] - stages["start"],
+            }
+        ),
+        "metric_values": {
+            metric: values.rename(columns={"u_id": "uid"})
+            for metric, values in metrics.groupby("metric", sort=False)
+        },
+    }
+
+
+def _synthetic_columns(n_uids, stage_names=("preprocessing", "inference", "postprocessing")):
+    now = time.time()
+    u_ids = np.arange(n_uids).astype(str)
+    starts = now - np.random.uniform(0, 8 * 3600, n_uids)
+    flags = np.random.randint(0, 4, n_uids)
+
+    stage_u_ids = np.repeat(u_ids, len(stage_names))
+    stage_starts = np.repeat(starts, len(stage_names)) + np.tile(
+        np.arange(len(stage_names)), n_uids
+    )
+
+    return {
+        "uids": {
+            "u_id": u_ids,
+            "start": starts,
+            "end": starts + len(stage_names),
+            "success": flags == 0,
+            "failed": flags == 1,
+            "in_process": flags == 2,
+            "long_running": flags == 3,
+        },
+        "stages": {
+            "u_id": stage_u_ids,
+            "stage": np.tile(np.array(stage_names), n_uids),
+            "start": stage_starts,
+            "end": stage_starts + np.random.exponential(0.1, len(stage_u_ids)),
+        },
+        "metrics": {
+            "u_id": u_ids,
+            "metric": np.full(n_uids, "metric1"),
+            "value": np.random.randint(0, 100, n_uids),
+            "timestamp": starts,
+            "stage": np.full(n_uids, stage_names[0]),
+        },
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python -m smartdash.frames 10000 100000 1000000
+    for n_uids in [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]:
+        columns = _synthetic_columns(n_uids)
+
+        start = time.time()
+        frames = to_frames(columns)
+        charts = get_dash_charts(frames)
+        frames_time = time.time() - start
+
+        start = time.time()
+        merge_frames(frames, to_frames(_synthetic_columns(n_uids // 100)), 0, time.time(), 1)
+        merge_time = time.time() - start
+
+        # a tenth of the uids left the window
+        start = time.time()
+        since = np.quantile(frames["uids"]["end"], 0.1)
+        merge_frames(frames, to_frames(_synthetic_columns(n_uids // 100)), since, time.time(), 1)
+        expire_time = time.time() - start
+
+        print(
+            f"{n_uids} uids: {frames_time * 1000:.0f} ms to build frames and charts, {merge_time * 1000:.0f} ms to merge an incremental refresh, {expire_time * 1000:.0f} ms with uids leaving the window"
+        )
@@ -0,0 +1,225 @@
+import os
+import time
+import sqlite3
+import calendar
+import threading
+from urllib.parse import quote, unquote
+
+from liteindex import DefinedIndex
+
+# sqlite column types of the schema types that can be added to an existing index
+ADDABLE_COLUMN_TYPES = {"string": "TEXT", "number": "NUMBER", "json": "JSON"}
+
+
+def open_index(name, schema, db_path):
+    # keys appended to a schema after the db was created are added to its table in place,
+    # freed pages are given back by the compactor's incremental vacuum instead of on every commit
+    try:
+        return DefinedIndex(name, schema=schema, db_path=db_path, auto_vacuum=False)
+    except ValueError:
+        existing_schema = DefinedIndex(name, db_path=db_path, auto_vacuum=False).schema
+        if list(schema)[: len(existing_schema)] != list(existing_schema):
+            raise
+
+        try:
+            with sqlite3.connect(db_path, timeout=30) as conn:
+                for key in list(schema)[len(existing_schema) :]:
+                    conn.execute(
+                        f'ALTER TABLE "{name}" ADD COLUMN "{key}" {ADDABLE_COLUMN_TYPES[schema[key]]}'
+                    )
+                    conn.execute(
+                        f'INSERT INTO "__{name}_meta" (key, value_type) VALUES (?, ?)',
+                        (key, schema[key]),
+                    )
+        except sqlite3.OperationalError as ex:
+            # another worker added the columns first
+            if "duplicate column" not in str(ex):
+                raise
+
+        return DefinedIndex(name, schema=schema, db_path=db_path, auto_vacuum=False)
+
+
+class Partitions(object):
+    # logs and key values are stored in one sqlite file per app and time partition,
+    # {root_dir}/{app_name}/{partition start in UTC}_{partition hours}h.db, each holding every index in `indexes`.
+    # queries only open the partitions overlapping their time range, expiring a partition is a file delete
+    # and writes to the current partition don't contend with reads of older ones
+    def __init__(self, root_dir, indexes, partition_hours=24):
+        # indexes: {index name: (schema, time key)}
+        self.root_dir = root_dir
+        self.indexes = indexes
+        self.partition_hours = partition_hours
+        self.partition_seconds = partition_hours * 3600
+
+        self._opened = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _app_dir(self, app_name):
+        # dots are quoted too so that app names like ".." stay inside root_dir
+        return os.path.join(
+            self.root_dir, quote(str(app_name), safe="").replace(".", "%2E")
+        )
+
+    def partition_start(self, timestamp):
+        return timestamp - timestamp % self.partition_seconds
+
+    def _path(self, app_name, start):
+        return os.path.join(
+            self._app_dir(app_name),
+            f"{time.strftime('%Y%m%dT%H', time.gmtime(start))}_{self.partition_hours}h.db",
+        )
+
+    def app_names(self):
+        return sorted(unquote(name) for name in os.listdir(self.root_dir))
+
+    def partitions(self, app_name, since=None, until=None, reversed_order=False):
+        # (start, end, path) of the partitions of app_name overlapping [since, until), in time order
+        app_dir = self._app_dir(app_name)
+        if not os.path.isdir(app_dir):
+            return []
+
+        partitions = []
+        for file_name in os.listdir(app_dir):
+            if not file_name.endswith("h.db"):
+                continue
+
+            # every file carries its own length, so changing the partition hours keeps older files readable
+            start, hours = file_name[: -len("h.db")].split("_")
+            start = calendar.timegm(time.strptime(start, "%Y%m%dT%H"))
+            end = start + float(hours) * 3600
+
+            if (since is None or end > since) and (until is None or start < until):
+                partitions.append((start, end, os.path.join(app_dir, file_name)))
+
+        return sorted(partitions, reverse=reversed_order)
+
+    def _index(self, path, name):
+        # indexes are opened once per process, and again if the compactor removed the file meanwhile
+        with self._lock:
+            if path not in self._opened or not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                opened = {}
+                for index_name, (schema, time_key) in self.indexes.items():
+                    opened[index_name] = open_index(index_name, schema, path)
+                    opened[index_name].optimize_for_query([time_key])
+                    if "u_id" in schema:
+                        opened[index_name].optimize_for_query(["u_id"])
+                    if "stage" in schema:
+                        opened[index_name].optimize_for_query(["stage", time_key])
+
+                self._opened[path] = opened
+
+            return self._opened[path][name]
+
+    def update(self, name, records):
+        # records: {id: record}, routed by their app_name and time key, a record sent again lands in the same partition
+        time_key = self.indexes[name][1]
+
+        batches = {}
+        for _id, record in records.items():
+            path = self._path(
+                record["app_name"],
+                self.partition_start(record.get(time_key) or time.time()),
+            )
+            if path not in batches:
+                batches[path] = {}
+            batches[path][_id] = record
+
+        for path, batch in batches.items():
+            self._index(path, name).update(batch)
+
+    def get(self, name, records, select_keys=None):
+        # records: {id: record}, the stored versions of the ones already in their partition
+        time_key = self.indexes[name][1]
+
+        ids_by_path = {}
+        for _id, record in records.items():
+            path = self._path(
+                record["app_name"],
+                self.partition_start(record.get(time_key) or time.time()),
+            )
+            if os.path.exists(path):
+                ids_by_path.setdefault(path, []).append(_id)
+
+        found = {}
+        for path, ids in ids_by_path.items():
+            found.update(self._index(path, name).get(ids, select_keys=select_keys))
+
+        return found
+
+    def find(self, app_name, name, _id, select_keys=None):
+        # a record of app_name by id alone, from the newest partition holding it
+        for _, _, path in self.partitions(app_name, reversed_order=True):
+            found = self._index(path, name).get([_id], select_keys=select_keys)
+            if found.get(_id) is not None:
+                return found[_id]
+
+        return None
+
+    def search(
+        self,
+        app_name,
+        name,
+        query={},
+        since=None,
+        until=None,
+        sort_by=None,
+        reversed_sort=False,
+        n=None,
+        select_keys=None,
+        meta_query={},
+    ):
+        # partitions are visited in time order, so results sorted by the time key stay sorted across them
+        results = {}
+        for _, _, path in self.partitions(app_name, since, until, reversed_sort):
+            results.update(
+                self._index(path, name).search(
+                    query=query,
+                    sort_by=sort_by,
+                    reversed_sort=reversed_sort,
+                    n=None if n is None else n - len(results),
+                    select_keys=select_keys,
+                    meta_query=meta_query,
+                )
+            )
+
+            if n is not None and len(results) >= n:
+                break
+
+        return results
+
+    def execute(self, app_name, sql, params=(), since=None, until=None):
+        # rows of a plain sql query run on every partition overlapping [since, until), for aggregates
+        # liteindex can't express, partial aggregates of the partitions are combined by the caller
+        if getattr(self._local, "connections", None) is None:
+            self._local.connections = {}
+
+        for _, _, path in self.partitions(app_name, since, until):
+            if path not in self._local.connections:
+                # opening the indexes first adds the columns appended to their schemas since the file was written
+                self._index(path, next(iter(self.indexes)))
+                self._local.connections[path] = sqlite3.connect(path, timeout=30)
+
+            yield from self._local.connections[path].execute(sql, params).fetchall()
+
+    def drop_before(self, app_name, before):
+        # removes the partitions of app_name that end before `before`, returns (n partitions, n bytes) removed
+        n_dropped, n_bytes = 0, 0
+        for start, end, path in self.partitions(app_name):
+            if end > before:
+                continue
+
+            with self._lock:
+                self._opened.pop(path, None)
+                for file_path in (path, f"{path}-wal", f"{path}-shm"):
+                    if os.path.exists(file_path):
+                        n_bytes += os.path.getsize(file_path)
+                        os.remove(file_path)
+
+            n_dropped += 1
+
+        return n_dropped, n_bytes
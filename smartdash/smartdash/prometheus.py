@@ -0,0 +1,182 @@
+import os
+import json
+import math
+import time
+import bisect
+import threading
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value))
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class PrometheusMetrics(object):
+    # counters, gauges and histograms kept in memory by every worker, served in the prometheus text format.
+    # Each worker dumps its values to {snapshot_dir}/{pid}.json at most every dump_interval seconds while busy,
+    # a scrape adds up the dumps of the other workers to its own live values without reading any db.
+    # Counters and histograms of exited workers stay in the totals so they never go backwards, their gauges don't
+    def __init__(self, snapshot_dir, definitions, dump_interval=1):
+        # definitions: {name: (type, help, histogram bucket upper bounds or None)}
+        self.snapshot_dir = snapshot_dir
+        self.definitions = definitions
+        self.dump_interval = dump_interval
+
+        # (name, labels): value, or [count per bucket..., count above the last bound, sum] for histograms
+        self.values = {}
+        self.dumped_at = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def clear(self):
+        # dumps of a previous server run, removed before the workers start
+        for file_name in os.listdir(self.snapshot_dir):
+            if file_name.endswith(".json"):
+                os.remove(os.path.join(self.snapshot_dir, file_name))
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, labels=(), value=0):
+        bounds = self.definitions[name][2]
+        key = (name, labels)
+        with self.lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0] * (len(bounds) + 1) + [0]
+
+            row[bisect.bisect_left(bounds, value)] += 1
+            row[-1] += value
+
+    def dump(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.dumped_at < self.dump_interval:
+            return
+        self.dumped_at = now
+
+        with self.lock:
+            data = json.dumps(
+                [[name, labels, value] for (name, labels), value in self.values.items()]
+            )
+
+        # replaced in one rename, so a scrape never reads a partial dump
+        path = os.path.join(self.snapshot_dir, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def _merged(self):
+        merged = {}
+
+        def merge(name, labels, value):
+            key = (name, labels)
+            if key not in merged:
+                merged[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] += value
+
+        for file_name in os.listdir(self.snapshot_dir):
+            if not file_name.endswith(".json"):
+                continue
+
+            pid = int(file_name[: -len(".json")])
+            if pid == os.getpid():
+                continue
+
+            try:
+                with open(os.path.join(self.snapshot_dir, file_name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            alive = _is_alive(pid)
+            for name, labels, value in snapshot:
+                # eg: metrics dropped since the dump was written
+                if name not in self.definitions:
+                    continue
+                if self.definitions[name][0] == "gauge" and not alive:
+                    continue
+
+                merge(name, tuple(tuple(label) for label in labels), value)
+
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                merge(name, labels, value)
+
+        return merged
+
+    def render(self, openmetrics=False):
+        by_name = {}
+        for (name, labels), value in self._merged().items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (metric_type, help_text, bounds) in self.definitions.items():
+            # openmetrics names a counter family without its _total suffix
+            family = (
+                name[: -len("_total")]
+                if openmetrics and metric_type == "counter" and name.endswith("_total")
+                else name
+            )
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+
+            for labels, value in sorted(
+                by_name.get(name, []),
+                key=lambda item: [(key, str(value)) for key, value in item[0]],
+            ):
+                if metric_type != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(list(bounds) + [math.inf], value[:-1]):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels + (('le', _format_value(float(bound))),))} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        if openmetrics:
+            lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
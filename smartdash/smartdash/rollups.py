@@ -0,0 +1,434 @@
+import math
+import time
+import sqlite3
+import threading
+
+# latency sketch: DDSketch style logarithmic buckets, any quantile read back is within 1% of the true latency
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_MIN_LATENCY = 1e-6
+
+
+def sketch_bucket(latency):
+    return math.ceil(math.log(max(latency, SKETCH_MIN_LATENCY), SKETCH_GAMMA))
+
+
+def sketch_value(bucket):
+    return 2 * SKETCH_GAMMA**bucket / (SKETCH_GAMMA + 1)
+
+
+def sketch_quantiles(buckets, quantiles):
+    # buckets: [(bucket, count)] sorted by bucket -> {"p50": value, ...}
+    total = sum(count for _, count in buckets)
+
+    values = {}
+    for quantile in quantiles:
+        rank = quantile * (total - 1)
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen > rank:
+                break
+
+        values[f"p{quantile * 100:g}"] = sketch_value(bucket)
+
+    return values
+
+
+class Rollups(object):
+    # per minute aggregates, exception groups, the tag -> uid inverted index and the catalog of tags/levels/stages, maintained at ingest
+    # and stored in smartdash.db, rows are updated with upserts so that every gunicorn worker can add to them concurrently
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+        with self._connection as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS stage_rollup (
+                    app_name TEXT, stage TEXT, minute INTEGER,
+                    count INTEGER, sum REAL, min REAL, max REAL,
+                    PRIMARY KEY (app_name, stage, minute)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS stage_latency_sketch (
+                    app_name TEXT, stage TEXT, minute INTEGER, bucket INTEGER, count INTEGER,
+                    PRIMARY KEY (app_name, stage, minute, bucket)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS status_rollup (
+                    app_name TEXT, status TEXT, minute INTEGER, count INTEGER,
+                    PRIMARY KEY (app_name, status, minute)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS exception_group (
+                    app_name TEXT, fingerprint TEXT, message TEXT, traceback TEXT, first_time REAL, last_time REAL,
+                    PRIMARY KEY (app_name, fingerprint)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS exception_rollup (
+                    app_name TEXT, fingerprint TEXT, minute INTEGER, count INTEGER,
+                    PRIMARY KEY (app_name, minute, fingerprint)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS tag_index (
+                    app_name TEXT, tag TEXT, u_id TEXT, last_time REAL,
+                    PRIMARY KEY (app_name, tag, u_id)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS catalog (
+                    app_name TEXT, kind TEXT, value TEXT, last_time REAL,
+                    PRIMARY KEY (app_name, kind, value)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS rolled_up_log (
+                    id TEXT PRIMARY KEY, rolled_up_at REAL
+                )"""
+            )
+
+    @property
+    def _connection(self):
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self.db_path, timeout=30)
+            # only takes effect on a new db, before WAL mode initializes the file, so the compactor never needs
+            # a full VACUUM of it. A no-op on existing dbs
+            self._local.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+
+        return self._local.connection
+
+    def rolled_up(self, ids):
+        # the ones among ids of logs already counted in the rollups
+        ids = list(ids)
+        found = set()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            found.update(
+                _id
+                for (_id,) in self._connection.execute(
+                    f"SELECT id FROM rolled_up_log WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+
+        return found
+
+    def add_logs(self, logs, stage_ends):
+        # logs: {id: log} not counted yet, stage_ends: the stages they ended. Their ids are recorded in the same
+        # transaction as their counts, so a log sent again after either commit failed is counted exactly once
+        with self._connection as conn:
+            rolled_up_at = time.time()
+            conn.executemany(
+                "INSERT OR IGNORE INTO rolled_up_log (id, rolled_up_at) VALUES (?, ?)",
+                [(_id, rolled_up_at) for _id in logs],
+            )
+            self._add_stage_ends(conn, stage_ends)
+            self._add_exceptions(conn, logs.values())
+
+    def _add_stage_ends(self, conn, stage_ends):
+        # stage_ends: (app_name, stage, status, end time, duration) of every stage that ended
+        stage_rows = {}
+        sketch_rows = {}
+        status_rows = {}
+
+        for app_name, stage, status, end_time, duration in stage_ends:
+            minute = int(end_time // 60)
+
+            status_key = (app_name, status, minute)
+            status_rows[status_key] = status_rows.get(status_key, 0) + 1
+
+            if duration is None:
+                continue
+
+            stage_key = (app_name, stage, minute)
+            if stage_key not in stage_rows:
+                stage_rows[stage_key] = [0, 0, duration, duration]
+            row = stage_rows[stage_key]
+            row[0] += 1
+            row[1] += duration
+            row[2] = min(row[2], duration)
+            row[3] = max(row[3], duration)
+
+            sketch_key = stage_key + (sketch_bucket(duration),)
+            sketch_rows[sketch_key] = sketch_rows.get(sketch_key, 0) + 1
+
+        conn.executemany(
+            """INSERT INTO stage_rollup (app_name, stage, minute, count, sum, min, max) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (app_name, stage, minute) DO UPDATE SET
+            count = count + excluded.count, sum = sum + excluded.sum,
+            min = MIN(min, excluded.min), max = MAX(max, excluded.max)""",
+            [key + tuple(row) for key, row in stage_rows.items()],
+        )
+        conn.executemany(
+            """INSERT INTO stage_latency_sketch (app_name, stage, minute, bucket, count) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (app_name, stage, minute, bucket) DO UPDATE SET count = count + excluded.count""",
+            [key + (count,) for key, count in sketch_rows.items()],
+        )
+        conn.executemany(
+            """INSERT INTO status_rollup (app_name, status, minute, count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (app_name, status, minute) DO UPDATE SET count = count + excluded.count""",
+            [key + (count,) for key, count in status_rows.items()],
+        )
+
+    def _add_exceptions(self, conn, logs):
+        # logs: new logs as ingested, the ones with a fingerprint are occurrences of their exception group,
+        # the group keeps the message of its latest occurrence and the traceback sent with the first
+        group_rows = {}
+        rollup_rows = {}
+
+        for log in logs:
+            if log.get("fingerprint") is None:
+                continue
+
+            key = (log["app_name"], log["fingerprint"])
+            message = log["messages"][0] if log.get("messages") else None
+            if key not in group_rows:
+                group_rows[key] = [message, log.get("traceback"), log["time"], log["time"]]
+            row = group_rows[key]
+            if log["time"] >= row[3]:
+                row[0] = message
+            row[1] = row[1] or log.get("traceback")
+            row[2] = min(row[2], log["time"])
+            row[3] = max(row[3], log["time"])
+
+            rollup_key = (key[0], key[1], int(log["time"] // 60))
+            rollup_rows[rollup_key] = rollup_rows.get(rollup_key, 0) + 1
+
+        conn.executemany(
+            """INSERT INTO exception_group (app_name, fingerprint, message, traceback, first_time, last_time)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (app_name, fingerprint) DO UPDATE SET
+            message = CASE WHEN excluded.last_time >= last_time THEN excluded.message ELSE message END,
+            traceback = COALESCE(traceback, excluded.traceback),
+            first_time = MIN(first_time, excluded.first_time), last_time = MAX(last_time, excluded.last_time)""",
+            [key + tuple(row) for key, row in group_rows.items()],
+        )
+        conn.executemany(
+            """INSERT INTO exception_rollup (app_name, fingerprint, minute, count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (app_name, minute, fingerprint) DO UPDATE SET count = count + excluded.count""",
+            [key + (count,) for key, count in rollup_rows.items()],
+        )
+
+    def exception_groups(self, app_name, since, n=10):
+        # the n exception groups with the most occurrences since, read from the per minute counts
+        return [
+            {
+                "fingerprint": fingerprint,
+                "count": count,
+                "message": message,
+                "traceback": traceback,
+                "first_time": first_time,
+                "last_time": last_time,
+            }
+            for fingerprint, count, message, traceback, first_time, last_time in self._connection.execute(
+                """SELECT counts.fingerprint, counts.count, message, traceback, first_time, last_time
+                FROM (
+                    SELECT fingerprint, SUM(count) AS count FROM exception_rollup
+                    WHERE app_name = ? AND minute >= ? GROUP BY fingerprint ORDER BY count DESC LIMIT ?
+                ) AS counts
+                JOIN exception_group ON exception_group.app_name = ? AND exception_group.fingerprint = counts.fingerprint
+                ORDER BY counts.count DESC""",
+                (app_name, int(since // 60), n, app_name),
+            ).fetchall()
+        ]
+
+    def add_catalog(self, records):
+        # records: logs and key values as ingested, with app_name
+        tag_rows = {}
+        catalog_rows = {}
+
+        for record in records:
+            app_name = record.get("app_name")
+            last_time = record.get("time", record.get("timestamp")) or 0
+
+            values = [("level", record.get("level")), ("stage", record.get("stage"))]
+            for tag in record.get("tags") or []:
+                values.append(("tag", tag))
+
+                key = (app_name, tag, record.get("u_id"))
+                tag_rows[key] = max(tag_rows.get(key, 0), last_time)
+
+            for kind, value in values:
+                if value is not None:
+                    key = (app_name, kind, value)
+                    catalog_rows[key] = max(catalog_rows.get(key, 0), last_time)
+
+        with self._connection as conn:
+            conn.executemany(
+                """INSERT INTO tag_index (app_name, tag, u_id, last_time) VALUES (?, ?, ?, ?)
+                ON CONFLICT (app_name, tag, u_id) DO UPDATE SET last_time = MAX(last_time, excluded.last_time)""",
+                [key + (last_time,) for key, last_time in tag_rows.items()],
+            )
+            conn.executemany(
+                """INSERT INTO catalog (app_name, kind, value, last_time) VALUES (?, ?, ?, ?)
+                ON CONFLICT (app_name, kind, value) DO UPDATE SET last_time = MAX(last_time, excluded.last_time)""",
+                [key + (last_time,) for key, last_time in catalog_rows.items()],
+            )
+
+    def backfill_catalog(self):
+        # builds the tag index and catalog from logs and key values stored before they existed, runs once
+        with self._connection as conn:
+            if conn.execute("SELECT 1 FROM catalog LIMIT 1").fetchone():
+                return
+
+            tables = {
+                name
+                for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            }
+            for table, time_key in (("logs", "time"), ("key_value", "timestamp")):
+                if table not in tables:
+                    continue
+
+                sources = {
+                    "tag": f'SELECT app_name, u_id, tags_each.value AS value, "{time_key}" AS last_time FROM "{table}", json_each("{table}".tags) AS tags_each',
+                    "stage": f'SELECT app_name, stage AS value, "{time_key}" AS last_time FROM "{table}" WHERE stage IS NOT NULL',
+                }
+                if table == "logs":
+                    sources["level"] = f'SELECT app_name, level AS value, "{time_key}" AS last_time FROM "{table}" WHERE level IS NOT NULL'
+
+                # WHERE true keeps sqlite from parsing ON CONFLICT as part of the SELECT
+                conn.execute(
+                    f"""INSERT INTO tag_index (app_name, tag, u_id, last_time)
+                    SELECT app_name, value, u_id, MAX(last_time) FROM ({sources["tag"]}) WHERE true GROUP BY app_name, value, u_id
+                    ON CONFLICT (app_name, tag, u_id) DO UPDATE SET last_time = MAX(last_time, excluded.last_time)"""
+                )
+
+                for kind, source in sources.items():
+                    conn.execute(
+                        f"""INSERT INTO catalog (app_name, kind, value, last_time)
+                        SELECT app_name, ?, value, MAX(last_time) FROM ({source}) WHERE true GROUP BY app_name, value
+                        ON CONFLICT (app_name, kind, value) DO UPDATE SET last_time = MAX(last_time, excluded.last_time)""",
+                        (kind,),
+                    )
+
+    def _delete_batches(self, table, where, params, batch_size):
+        # batch_size rows per transaction, so that ingest commits interleave with a large expiry
+        n_deleted = 0
+        while True:
+            with self._connection as conn:
+                n_batch = conn.execute(
+                    f"""DELETE FROM "{table}" WHERE rowid IN (
+                    SELECT rowid FROM "{table}" WHERE {where} LIMIT ?)""",
+                    (*params, batch_size),
+                ).rowcount
+            n_deleted += n_batch
+
+            if n_batch < batch_size:
+                return n_deleted
+            # yield to the request greenlets between batches
+            time.sleep(0.01)
+
+    def expire_rolled_up(self, before, batch_size=1000):
+        # ids of logs rolled up before `before`, kept only as long as an uploader may still retry them.
+        # Rows are in insertion order, so the batches find the expired ones first without an index
+        return self._delete_batches(
+            "rolled_up_log", "rolled_up_at < ?", (before,), batch_size
+        )
+
+    def expire(self, app_name, raw_before, rollup_before, batch_size=1000):
+        # the tag index and catalog describe raw records and expire with them, rollups are kept until rollup_before
+        n_deleted = 0
+        for table in ("tag_index", "catalog"):
+            n_deleted += self._delete_batches(
+                table, "app_name = ? AND last_time < ?", (app_name, raw_before), batch_size
+            )
+        for table in (
+            "stage_rollup",
+            "stage_latency_sketch",
+            "status_rollup",
+            "exception_rollup",
+        ):
+            n_deleted += self._delete_batches(
+                table,
+                "app_name = ? AND minute < ?",
+                (app_name, int(rollup_before // 60)),
+                batch_size,
+            )
+        n_deleted += self._delete_batches(
+            "exception_group",
+            "app_name = ? AND last_time < ?",
+            (app_name, rollup_before),
+            batch_size,
+        )
+
+        return n_deleted
+
+    def catalog(self, app_name, since):
+        catalog = {"tags": [], "levels": [], "stages": []}
+        for kind, value in self._connection.execute(
+            """SELECT kind, value FROM catalog WHERE app_name = ? AND last_time >= ? ORDER BY kind, value""",
+            (app_name, since),
+        ).fetchall():
+            catalog[f"{kind}s"].append(value)
+
+        return catalog
+
+    def tag_uids(self, app_name, tags, since, limit):
+        return [
+            u_id
+            for (u_id,) in self._connection.execute(
+                f"""SELECT DISTINCT u_id FROM tag_index
+                WHERE app_name = ? AND tag IN ({", ".join("?" for _ in tags)}) AND last_time >= ? LIMIT ?""",
+                (app_name, *tags, since, limit),
+            ).fetchall()
+        ]
+
+    def stage_stats(self, app_name, since):
+        return {
+            stage: {"count": count, "sum": total, "min": min_, "max": max_}
+            for stage, count, total, min_, max_ in self._connection.execute(
+                """SELECT stage, SUM(count), SUM(sum), MIN(min), MAX(max) FROM stage_rollup
+                WHERE app_name = ? AND minute >= ? GROUP BY stage""",
+                (app_name, int(since // 60)),
+            ).fetchall()
+        }
+
+    def status_counts(self, app_name, since):
+        return dict(
+            self._connection.execute(
+                """SELECT status, SUM(count) FROM status_rollup
+                WHERE app_name = ? AND minute >= ? GROUP BY status""",
+                (app_name, int(since // 60)),
+            ).fetchall()
+        )
+
+    def stage_percentiles(self, app_name, since, quantiles=(0.5, 0.95, 0.99)):
+        # sketches of all minutes in the window are merged by summing bucket counts
+        buckets_by_stage = {}
+        for stage, bucket, count in self._connection.execute(
+            """SELECT stage, bucket, SUM(count) FROM stage_latency_sketch
+            WHERE app_name = ? AND minute >= ? GROUP BY stage, bucket ORDER BY stage, bucket""",
+            (app_name, int(since // 60)),
+        ).fetchall():
+            if stage not in buckets_by_stage:
+                buckets_by_stage[stage] = []
+            buckets_by_stage[stage].append((bucket, count))
+
+        return {
+            stage: sketch_quantiles(buckets, quantiles)
+            for stage, buckets in buckets_by_stage.items()
+        }
+
+    def stage_series(self, app_name, since, bucket_seconds):
+        series = {"stage": [], "time": [], "count": [], "mean": [], "min": [], "max": []}
+
+        for stage, bucket, count, total, min_, max_ in self._connection.execute(
+            """SELECT stage, (minute * 60) / ? AS bucket, SUM(count), SUM(sum), MIN(min), MAX(max)
+            FROM stage_rollup WHERE app_name = ? AND minute >= ?
+            GROUP BY stage, bucket ORDER BY stage, bucket""",
+            (int(bucket_seconds), app_name, int(since // 60)),
+        ).fetchall():
+            series["stage"].append(stage)
+            series["time"].append(bucket * bucket_seconds)
+            series["count"].append(count)
+            series["mean"].append(total / count)
+            series["min"].append(min_)
+            series["max"].append(max_)
+
+        return series
@@ -5,58 +5,1583 @@ import gevent
 import os
 import time
 import json
+import math
 import uuid
+import zlib
 import pickle
+import fcntl
+import socket
+import sqlite3
+import threading
+import collections
 import falcon
 import logging
 import requests
 import mimetypes
 from datetime import datetime
 
-from liteindex import DefinedIndex
+from .rollups import Rollups, sketch_quantiles
+from .partitions import Partitions, open_index
+from .prometheus import (
+    PrometheusMetrics,
+    PROMETHEUS_CONTENT_TYPE,
+    OPENMETRICS_CONTENT_TYPE,
+)
+
+save_dir = os.getenv("SMARTDASH_SAVE_DIR", "./")
+db_path = os.path.join(save_dir, "smartdash.db")
+
+LOG_SCHEMA = {
+    "app_name": "string",
+    "u_id": "string",
+    "stage": "string",
+    "level": "string",
+    "messages": "json",
+    "time": "number",
+    "tags": "json",
+    "duration": "number",
+    "status": "string",
+    "fingerprint": "string",
+    "traceback": "string",
+}
 
-db_path = os.path.join(os.getenv("SMARTDASH_SAVE_DIR", "./"), "smartdash.db")
+KV_SCHEMA = {
+    "app_name": "string",
+    "u_id": "string",
+    "key": "string",
+    "num_value": "number",
+    "str_value": "string",
+    "other_value": "other",
+    "name": "string",
+    "timestamp": "number",
+    "stage": "string",
+    "tags": "json",
+    "metric_type": "string",
+    "count": "number",
+    "sum": "number",
+    "min": "number",
+    "max": "number",
+    "buckets": "json",
+    "blob": "string",
+    "blob_size": "number",
+}
 
-LOG_INDEX = DefinedIndex(
-    "logs",
-    schema={
-        "app_name": "string",
-        "u_id": "string",
-        "stage": "string",
-        "level": "string",
-        "messages": "json",
-        "time": "number",
-        "tags": "json",
+# large key values sent apart from their key value row, ids are content hashes when the client dedups them
+BLOB_SCHEMA = {
+    "app_name": "string",
+    "data": "string",
+    "size": "number",
+    "timestamp": "number",
+}
+
+# logs and key values are partitioned per app into SMARTDASH_PARTITION_HOURS (default 24) files under save_dir/partitions,
+# rollups, the tag index and the catalog stay in smartdash.db
+PARTITIONS = Partitions(
+    os.path.join(save_dir, "partitions"),
+    {
+        "logs": (LOG_SCHEMA, "time"),
+        "key_value": (KV_SCHEMA, "timestamp"),
+        "blobs": (BLOB_SCHEMA, "timestamp"),
     },
-    db_path=db_path,
+    partition_hours=int(os.getenv("SMARTDASH_PARTITION_HOURS", 24)),
 )
 
-KV_INDEX = DefinedIndex(
-    "key_value",
-    schema={
-        "app_name": "string",
-        "u_id": "string",
-        "key": "string",
-        "num_value": "number",
-        "str_value": "string",
-        "other_value": "other",
-        "name": "string",
-        "timestamp": "number",
-        "stage": "string",
-        "tags": "json",
+ROLLUPS = Rollups(db_path)
+ROLLUPS.backfill_catalog()
+
+
+def migrate_unpartitioned(batch_size=10000):
+    # logs and key values stored in smartdash.db before partitioning are moved to their partitions once, on startup
+    with sqlite3.connect(db_path) as conn:
+        tables = {
+            name
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+
+    for name, (schema, _) in PARTITIONS.indexes.items():
+        if name not in tables:
+            continue
+
+        index = open_index(name, schema, db_path)
+        n_moved = 0
+        while True:
+            records = index.search(n=batch_size)
+            if not records:
+                break
+
+            ids = list(records)
+            PARTITIONS.update(name, records)
+            index.delete(ids)
+            n_moved += len(ids)
+
+        index.drop()
+        print(f"smartdash: moved {n_moved} {name} records from smartdash.db to partitions")
+
+
+migrate_unpartitioned()
+
+# blobs larger than this are dropped at ingest
+MAX_BLOB_SIZE = int(os.getenv("SMARTDASH_MAX_BLOB_SIZE", 1024 * 1024))
+
+# u_id of the counter/gauge/histogram summaries sent by smartlogger
+METRICS_U_ID = "__metrics__"
+# u_id of the sampled out / rate limited counts sent by smartlogger
+SAMPLING_U_ID = "__smartlogger__"
+
+# tag filters narrowed to at most this many uids through the tag index, larger matches scan the time range
+TAG_INDEX_MAX_UIDS = int(os.getenv("SMARTDASH_TAG_INDEX_MAX_UIDS", 500))
+
+
+WIRE_CONTENT_TYPE = "application/vnd.smartdash.columns+json"
+
+# pickle bodies (smartlogger --wire_format pickle) can run arbitrary code when loaded, they are refused unless
+# SMARTDASH_ALLOW_PICKLE=1 and then only when sent with the explicit legacy content type
+PICKLE_CONTENT_TYPE = "application/vnd.smartdash.pickle"
+ALLOW_PICKLE = os.getenv("SMARTDASH_ALLOW_PICKLE", "0") == "1"
+
+
+def decode_batch(batch):
+    columns = {}
+    for key, column in batch["columns"].items():
+        if isinstance(column, dict):
+            dictionary = column["dict"]
+            if key == "tags":
+                column = [
+                    [dictionary[code] for code in codes] if codes is not None else None
+                    for codes in column["codes"]
+                ]
+            else:
+                column = [dictionary[code] for code in column["codes"]]
+
+        columns[key] = column
+
+    return {
+        _id: {key: column[i] for key, column in columns.items()}
+        for i, _id in enumerate(batch["ids"])
+    }
+
+
+def read_batch(req):
+    # read (and inflated) piece by piece, a body growing past MAX_BODY_SIZE is refused before it is whole
+    body = bytearray()
+    for chunk in read_body(req):
+        body += chunk
+        if len(body) > MAX_BODY_SIZE:
+            raise falcon.HTTPContentTooLarge(
+                description=f"request bodies are limited to {MAX_BODY_SIZE} bytes"
+            )
+
+    if req.content_type and req.content_type.startswith(WIRE_CONTENT_TYPE):
+        return decode_batch(json.loads(body))
+
+    if (
+        ALLOW_PICKLE
+        and req.content_type
+        and req.content_type.startswith(PICKLE_CONTENT_TYPE)
+    ):
+        return pickle.loads(body)
+
+    raise falcon.HTTPUnsupportedMediaType(
+        description=f"Content-Type must be {WIRE_CONTENT_TYPE}"
+    )
+
+
+# /logs/stream and /key_values/stream bodies are a sequence of frames, each a 4 byte big endian length
+# followed by a json [id, record], optionally gzip compressed as a whole
+STREAM_CONTENT_TYPE = "application/vnd.smartdash.frames"
+STREAM_READ_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = int(os.getenv("SMARTDASH_STREAM_CHUNK_SIZE", 512))
+STREAM_RETRY_AFTER = int(os.getenv("SMARTDASH_STREAM_RETRY_AFTER", 5))
+# a single record frame larger than this is refused with 413, so a stream's buffer stays bounded
+MAX_FRAME_SIZE = int(os.getenv("SMARTDASH_MAX_FRAME_SIZE", 4 * 1024 * 1024))
+# and so is a /logs, /key_values or /blobs batch body larger than this, after gzip inflation
+MAX_BODY_SIZE = int(os.getenv("SMARTDASH_MAX_BODY_SIZE", 64 * 1024 * 1024))
+
+# streams ingested at once per worker, further streams are turned away with 429 until one finishes
+STREAM_SLOTS = threading.BoundedSemaphore(int(os.getenv("SMARTDASH_MAX_STREAMS", 4)))
+
+
+def read_body(req):
+    # the request body in pieces of at most STREAM_READ_SIZE bytes, a gzip body is inflated piece by piece
+    # so that a small body decompressing to gigabytes (gzip bomb) never sits in memory at once
+    decompressor = (
+        zlib.decompressobj(wbits=31)
+        if req.get_header("Content-Encoding") == "gzip"
+        else None
+    )
+
+    while True:
+        chunk = req.bounded_stream.read(STREAM_READ_SIZE)
+        if not chunk:
+            break
+
+        if decompressor is None:
+            yield chunk
+            continue
+
+        while True:
+            data = decompressor.decompress(chunk, STREAM_READ_SIZE)
+            yield data
+
+            chunk = decompressor.unconsumed_tail
+            if not chunk and len(data) < STREAM_READ_SIZE:
+                break
+
+
+def read_frames(req):
+    buffer = bytearray()
+
+    for data in read_body(req):
+        buffer += data
+
+        offset = 0
+        while len(buffer) - offset >= 4:
+            size = int.from_bytes(buffer[offset : offset + 4], "big")
+            if size > MAX_FRAME_SIZE:
+                raise falcon.HTTPContentTooLarge(
+                    description=f"frames are limited to {MAX_FRAME_SIZE} bytes"
+                )
+            if len(buffer) - offset - 4 < size:
+                break
+
+            yield json.loads(buffer[offset + 4 : offset + 4 + size])
+            offset += 4 + size
+
+        del buffer[:offset]
+
+    if buffer:
+        raise falcon.HTTPBadRequest(description="stream ended inside a frame")
+
+
+def ingest_stream(name, req, resp):
+    if not (req.content_type and req.content_type.startswith(STREAM_CONTENT_TYPE)):
+        raise falcon.HTTPUnsupportedMediaType(
+            description=f"Content-Type must be {STREAM_CONTENT_TYPE}"
+        )
+
+    if not STREAM_SLOTS.acquire(blocking=False):
+        raise falcon.HTTPTooManyRequests(retry_after=STREAM_RETRY_AFTER)
+
+    n_records = 0
+    try:
+        # records are committed in chunks of STREAM_CHUNK_SIZE so memory and write lock time stay bounded
+        chunk = {}
+        for _id, record in read_frames(req):
+            chunk[_id] = record
+
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                INGEST_LEADER.write(name, chunk)
+                n_records += len(chunk)
+                chunk = {}
+
+        if chunk:
+            INGEST_LEADER.write(name, chunk)
+            n_records += len(chunk)
+    finally:
+        STREAM_SLOTS.release()
+
+    resp.media = {"success": True, "n_records": n_records}
+    resp.status = falcon.HTTP_200
+
+
+def adds_to_rollups(log):
+    # stage ends and exceptions are counted in the rollups
+    return (
+        log.get("fingerprint") is not None
+        or log.get("level") == "EXCEPTION"
+        or log.get("status") is not None
+        or (
+            bool(log.get("messages"))
+            and log["messages"][0] in ("Stage succeeded", "Stage failed")
+        )
+    )
+
+
+def get_new_logs(logs):
+    # the logs adding to the rollups that aren't counted yet. Logs sent again by an uploader retry, including
+    # ones stored by a commit whose rollups then failed, are looked up in the rollups' own record of what they counted,
+    # kept SMARTDASH_ROLLUP_DEDUP_DAYS
+    candidates = {_id: log for _id, log in logs.items() if adds_to_rollups(log)}
+    counted = ROLLUPS.rolled_up(candidates)
+
+    return {_id: log for _id, log in candidates.items() if _id not in counted}
+
+
+def get_stage_ends(new_logs, logs):
+    # (app_name, stage, status, end time, duration) of the stages ended by new_logs, logs is their whole batch
+    starts = {}
+    ends = []
+    stage_ends = []
+    for log in new_logs.values():
+        if log.get("stage") is None or not log.get("messages"):
+            continue
+
+        key = (log["app_name"], log["u_id"], log["stage"])
+        if log.get("status") is not None:
+            # stages logged by newer smartloggers carry their duration and status
+            stage_ends.append(
+                (key[0], key[2], log["status"], log["time"], log.get("duration"))
+            )
+        elif log["messages"][0] in ("Stage succeeded", "Stage failed"):
+            ends.append((key, log))
+
+    if ends:
+        # starts sent in the same batch aren't stored yet
+        for log in logs.values():
+            if (
+                log.get("stage") is not None
+                and log.get("messages")
+                and log["messages"][0] == "Stage started"
+            ):
+                starts[(log["app_name"], log["u_id"], log["stage"])] = log["time"]
+
+    # older smartloggers only log Stage started/succeeded/failed, their duration is paired up here
+    for key, log in ends:
+        if key not in starts:
+            found = PARTITIONS.search(
+                key[0],
+                "logs",
+                query={"app_name": key[0], "u_id": key[1], "stage": key[2]},
+                sort_by="time",
+                n=1,
+                select_keys=["time"],
+            )
+            starts[key] = next(iter(found.values()))["time"] if found else None
+
+        stage_ends.append(
+            (
+                key[0],
+                key[2],
+                "success" if log["messages"][0] == "Stage succeeded" else "failed",
+                log["time"],
+                log["time"] - starts[key] if starts[key] is not None else None,
+            )
+        )
+
+    return stage_ends
+
+
+def parse_buckets(value):
+    # "0.1,1,10" -> (0.1, 1.0, 10.0)
+    return tuple(float(bound) for bound in value.split(","))
+
+
+# served from /metrics, updated in memory by the ingest writer of every worker
+PROMETHEUS = PrometheusMetrics(
+    os.path.join(save_dir, "prometheus"),
+    {
+        "smartdash_stage_ends_total": (
+            "counter",
+            "Stages ended, by app, stage and status",
+            None,
+        ),
+        "smartdash_stage_duration_seconds": (
+            "histogram",
+            "Duration of ended stages, by app, stage and status",
+            parse_buckets(
+                os.getenv(
+                    "SMARTDASH_METRICS_STAGE_BUCKETS",
+                    "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,300",
+                )
+            ),
+        ),
+        "smartdash_exceptions_total": (
+            "counter",
+            "Exception logs, by app",
+            None,
+        ),
+        "smartdash_ingested_records_total": (
+            "counter",
+            "Records committed, by app and kind (logs, key_value, blobs)",
+            None,
+        ),
+        "smartdash_ingest_batch_records": (
+            "histogram",
+            "Records per upload request or stream chunk, by kind",
+            (1, 10, 100, 500, 1000, 5000, 10000, 50000),
+        ),
+        "smartdash_ingest_rejected_total": (
+            "counter",
+            "Uploads turned away with 429 because the ingest queue was full",
+            None,
+        ),
+        "smartdash_ingest_queue_depth": (
+            "gauge",
+            "Upload batches waiting for the ingest writer",
+            None,
+        ),
+        "smartdash_ingest_queued_records": (
+            "gauge",
+            "Records waiting for the ingest writer",
+            None,
+        ),
+        "smartdash_commit_records": (
+            "histogram",
+            "Records per ingest commit",
+            (1, 10, 100, 500, 1000, 5000, 10000, 50000),
+        ),
+        "smartdash_commit_duration_seconds": (
+            "histogram",
+            "Time to commit a batch of queued records, including rollups",
+            (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+        ),
+        "smartdash_commit_errors_total": (
+            "counter",
+            "Ingest commits that failed",
+            None,
+        ),
     },
-    db_path=db_path,
 )
 
 
+def observe_ingest(batches, new_logs, stage_ends, duration):
+    # per app stage, exception and record counts of a commit, from what the writer already has in memory
+    for app_name, stage, status, _, stage_duration in stage_ends:
+        labels = (("app", app_name), ("stage", stage), ("status", status))
+        PROMETHEUS.inc("smartdash_stage_ends_total", labels)
+        if stage_duration is not None:
+            PROMETHEUS.observe("smartdash_stage_duration_seconds", labels, stage_duration)
+
+    for log in new_logs.values():
+        if log.get("level") == "EXCEPTION":
+            PROMETHEUS.inc("smartdash_exceptions_total", (("app", log["app_name"]),))
+
+    n_records = 0
+    for name, batch in batches.items():
+        counts = collections.Counter(record.get("app_name") for record in batch.values())
+        for app_name, count in counts.items():
+            PROMETHEUS.inc(
+                "smartdash_ingested_records_total",
+                (("app", app_name), ("kind", name)),
+                count,
+            )
+        n_records += len(batch)
+
+    PROMETHEUS.observe("smartdash_commit_records", (), n_records)
+    PROMETHEUS.observe("smartdash_commit_duration_seconds", (), duration)
+
+
+class IngestWriter(object):
+    # request handlers enqueue decoded batches and wait, a single writer (in the worker leading ingest, see
+    # IngestLeader) commits everything queued within max_latency seconds (or max_records) as one transaction per partition
+    def __init__(self, max_latency, max_records, max_queued_records):
+        self.max_latency = max_latency
+        self.max_records = max_records
+        self.max_queued_records = max_queued_records
+
+        self.queue = collections.deque()
+        self.n_queued_records = 0
+        self.condition = threading.Condition()
+        self.pid = None
+
+    def _ensure_started(self):
+        # started lazily so that every forked gunicorn worker runs its own writer
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def write(self, name, records):
+        if self.n_queued_records >= self.max_queued_records:
+            # store is behind, let the uploader back off instead of queueing more
+            PROMETHEUS.inc("smartdash_ingest_rejected_total")
+            raise falcon.HTTPTooManyRequests(retry_after=STREAM_RETRY_AFTER)
+
+        PROMETHEUS.observe("smartdash_ingest_batch_records", (("kind", name),), len(records))
+
+        item = {"name": name, "records": records, "done": threading.Event()}
+
+        with self.condition:
+            self._ensure_started()
+            self.queue.append(item)
+            self.n_queued_records += len(records)
+            self.condition.notify_all()
+
+        item["done"].wait()
+
+        if isinstance(item.get("error"), sqlite3.OperationalError):
+            raise falcon.HTTPTooManyRequests(retry_after=STREAM_RETRY_AFTER)
+        elif item.get("error"):
+            raise item["error"]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+
+                deadline = time.time() + self.max_latency
+                while self.n_queued_records < self.max_records:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                items = list(self.queue)
+                self.queue.clear()
+                self.n_queued_records = 0
+
+            batches = {}
+            for item in items:
+                if item["name"] not in batches:
+                    batches[item["name"]] = {}
+                batches[item["name"]].update(item["records"])
+
+            if "blobs" in batches:
+                batches["blobs"] = {
+                    _id: blob
+                    for _id, blob in batches["blobs"].items()
+                    if len(blob.get("data") or "") <= MAX_BLOB_SIZE
+                }
+
+            error = None
+            started = time.perf_counter()
+            try:
+                # decided before the logs are stored, and marked as counted only with the rollups' own commit
+                new_logs = get_new_logs(batches["logs"]) if "logs" in batches else {}
+                stage_ends = get_stage_ends(new_logs, batches.get("logs", {}))
+                records = [
+                    record
+                    for name in ("logs", "key_value")
+                    for record in batches.get(name, {}).values()
+                ]
+
+                for name, batch in batches.items():
+                    PARTITIONS.update(name, batch)
+
+                if new_logs:
+                    ROLLUPS.add_logs(new_logs, stage_ends)
+                ROLLUPS.add_catalog(records)
+            except Exception as ex:
+                error = ex
+
+            for item in items:
+                item["error"] = error
+                item["done"].set()
+
+            if error is None:
+                observe_ingest(
+                    batches, new_logs, stage_ends, time.perf_counter() - started
+                )
+            else:
+                PROMETHEUS.inc("smartdash_commit_errors_total")
+            self.observe_queue()
+            # dumped right away once the queue is drained, so idle workers don't leave their last commit out
+            PROMETHEUS.dump(force=not self.queue)
+
+    def observe_queue(self):
+        PROMETHEUS.set("smartdash_ingest_queue_depth", (), len(self.queue))
+        PROMETHEUS.set("smartdash_ingest_queued_records", (), self.n_queued_records)
+
+
+INGEST_WRITER = IngestWriter(
+    max_latency=float(os.getenv("SMARTDASH_COMMIT_MAX_LATENCY", 0.01)),
+    max_records=int(os.getenv("SMARTDASH_COMMIT_MAX_RECORDS", 10000)),
+    max_queued_records=int(os.getenv("SMARTDASH_MAX_QUEUED_RECORDS", 100000)),
+)
+
+
+def send_message(conn, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    conn.sendall(len(data).to_bytes(8, "big") + data)
+
+
+def recv_message(conn_file):
+    # None once the other side closed the connection
+    header = conn_file.read(8)
+    if len(header) < 8:
+        return None
+
+    return pickle.loads(conn_file.read(int.from_bytes(header, "big")))
+
+
+class IngestLeader(object):
+    # one worker at a time holds {db_path}.ingest.lock and is the only one committing, to the partitions and
+    # smartdash.db alike, so workers never contend for sqlite write locks and all uploads are coalesced by one
+    # IngestWriter. The other workers forward their decoded batches to it over a unix socket only they can open
+    # (pickled, between processes of this server). If the leader exits its lock is released and another worker
+    # takes over within a second, uploads forwarded meanwhile get 429 and are retried by the uploader
+    def __init__(self, socket_path, lock_path):
+        self.socket_path = socket_path
+        self.lock_path = lock_path
+        self.is_leader = False
+        self.connections = collections.deque()
+
+    def start(self):
+        threading.Thread(target=self._elect, daemon=True).start()
+
+    def _elect(self):
+        while True:
+            lock_file = open(self.lock_path, "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                time.sleep(1)
+                continue
+
+            # the lock is held for as long as this worker leads
+            try:
+                self._lead()
+            except Exception as ex:
+                print(f"smartdash: leading ingest failed: {ex}")
+
+            self.is_leader = False
+            lock_file.close()
+            time.sleep(1)
+
+    def _lead(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            listener.listen(128)
+            self.is_leader = True
+
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile("rb") as conn_file:
+            while True:
+                request = recv_message(conn_file)
+                if request is None:
+                    return
+
+                try:
+                    INGEST_WRITER.write(*request)
+                    reply = "ok"
+                except falcon.HTTPTooManyRequests:
+                    reply = "busy"
+                except Exception as ex:
+                    reply = repr(ex)
+
+                send_message(conn, reply)
+
+    def write(self, name, records):
+        if self.is_leader:
+            return INGEST_WRITER.write(name, records)
+
+        # connections to the leader are reused, one request at a time each
+        try:
+            conn, conn_file = self.connections.popleft()
+        except IndexError:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                conn.connect(self.socket_path)
+            except OSError:
+                # no leader yet, or the previous one just exited
+                conn.close()
+                raise falcon.HTTPTooManyRequests(retry_after=STREAM_RETRY_AFTER)
+            conn_file = conn.makefile("rb")
+
+        try:
+            send_message(conn, (name, records))
+            reply = recv_message(conn_file)
+        except OSError:
+            reply = None
+
+        if reply is None:
+            # the leader went away mid request, the uploader retries against the next one
+            conn_file.close()
+            conn.close()
+            raise falcon.HTTPTooManyRequests(retry_after=STREAM_RETRY_AFTER)
+
+        self.connections.append((conn, conn_file))
+        if reply == "busy":
+            raise falcon.HTTPTooManyRequests(retry_after=STREAM_RETRY_AFTER)
+        elif reply != "ok":
+            raise falcon.HTTPInternalServerError(description=reply)
+
+
+INGEST_LEADER = IngestLeader(
+    socket_path=f"{db_path}.ingest.sock", lock_path=f"{db_path}.ingest.lock"
+)
+
+
+def get_app_names():
+    return PARTITIONS.app_names()
+
+
+# records committed up to this many seconds before a query are fetched again by the next incremental query,
+# covering transactions of other workers that were still in flight
+CURSOR_OVERLAP = float(os.getenv("SMARTDASH_CURSOR_OVERLAP", 30))
+
+
+def get_updated_uids(app_name, since, since_cursor):
+    u_ids = set()
+    for name in ("logs", "key_value"):
+        for record in PARTITIONS.search(
+            app_name,
+            name,
+            query={"app_name": app_name},
+            since=since,
+            meta_query={"updated_at": {"$gt": since_cursor}},
+            select_keys=["u_id"],
+        ).values():
+            u_ids.add(record["u_id"])
+
+    return sorted(u_ids)
+
+
+def uid_status(stage_status, n_stages, start, now, long_running_n_hours):
+    # stage_status: {stage: "success" or "failed"} of the stages a uid ended out of its n_stages
+    failed = "failed" in stage_status.values()
+    success = not failed and len(stage_status) == n_stages
+    long_running = (
+        not success and not failed and now - start > long_running_n_hours * 3600
+    )
+
+    return {
+        "success": success,
+        "failed": failed,
+        "in_process": not success and not failed and not long_running,
+        "long_running": long_running,
+    }
+
+
+def get_dash_metrics(app_name, last_n_hours, long_running_n_hours=1, since_cursor=None):
+    now = time.time()
+    since = now - last_n_hours * 3600
+
+    # with since_cursor only the uids with records committed after the cursor are returned, in full
+    if since_cursor is None:
+        u_id_queries = [{}]
+    else:
+        u_ids = get_updated_uids(app_name, since, since_cursor)
+        u_id_queries = [
+            {"u_id": {"$in": u_ids[i : i + 500]}} for i in range(0, len(u_ids), 500)
+        ]
+
+    data_by_uid = {}
+    stage_status_by_uid = {}
+
+    for log in (
+        log
+        for u_id_query in u_id_queries
+        for log in PARTITIONS.search(
+            app_name,
+            "logs",
+            query={"app_name": app_name, "time": {"$gte": since}, **u_id_query},
+            since=since,
+            sort_by="time",
+            select_keys=["u_id", "stage", "level", "messages", "time", "tags"],
+        ).values()
+    ):
+        if log["u_id"] not in data_by_uid:
+            data_by_uid[log["u_id"]] = {
+                "logs": [],
+                "metrics": [],
+                "stage_wise_times": {},
+            }
+            stage_status_by_uid[log["u_id"]] = {}
+
+        data = data_by_uid[log["u_id"]]
+        data["logs"].append(
+            {
+                "u_id": log["u_id"],
+                "stage": log["stage"],
+                "level": log["level"],
+                "messages": log["messages"],
+                "tags": log["tags"],
+                "timestamp": log["time"],
+            }
+        )
+
+        stage = log["stage"]
+        if stage is None:
+            continue
+
+        # logs are sorted by time, so a stage spans from its first to its last log
+        if stage not in data["stage_wise_times"]:
+            data["stage_wise_times"][stage] = {"start": log["time"], "end": log["time"]}
+        data["stage_wise_times"][stage]["end"] = log["time"]
+
+        if log["messages"] and log["messages"][0] == "Stage succeeded":
+            stage_status_by_uid[log["u_id"]][stage] = "success"
+        elif log["messages"] and log["messages"][0] == "Stage failed":
+            stage_status_by_uid[log["u_id"]][stage] = "failed"
+
+    for kv in (
+        kv
+        for u_id_query in u_id_queries
+        for kv in PARTITIONS.search(
+            app_name,
+            "key_value",
+            query={"app_name": app_name, "timestamp": {"$gte": since}, **u_id_query},
+            since=since,
+            sort_by="timestamp",
+            select_keys=["u_id", "key", "num_value", "timestamp", "stage"],
+        ).values()
+    ):
+        # only numeric values of uids with logs in the time range are charted
+        if kv["num_value"] is None or kv["u_id"] not in data_by_uid:
+            continue
+
+        data_by_uid[kv["u_id"]]["metrics"].append(
+            {
+                "metric": kv["key"],
+                "value": kv["num_value"],
+                "timestamp": kv["timestamp"],
+                "stage": kv["stage"],
+            }
+        )
+
+    for u_id, data in data_by_uid.items():
+        data.update(
+            uid_status(
+                stage_status_by_uid[u_id],
+                len(data["stage_wise_times"]),
+                data["logs"][0]["timestamp"],
+                now,
+                long_running_n_hours,
+            )
+        )
+
+    return data_by_uid
+
+
+def get_logs(
+    app_name,
+    since,
+    until=None,
+    tags=None,
+    level=None,
+    stage=None,
+    u_id=None,
+    limit=100,
+    cursor=None,
+):
+    # newest first, in (time, id) order one page at a time: the cursor is "{time}:{id}" of the last log of the
+    # previous page, so logs sharing a timestamp across a page boundary are neither skipped nor repeated
+    query = {"app_name": app_name, "time": {"$gte": since}}
+
+    cursor_time, cursor_id = None, None
+    if cursor is not None:
+        cursor_time, _, cursor_id = str(cursor).rpartition(":")
+        cursor_time = float(cursor_time)
+        query["time"]["$lt"] = cursor_time
+    elif until is not None:
+        query["time"]["$lt"] = until
+
+    if tags:
+        query["tags"] = {"$in": tags}
+
+        # the tag index gives the uids carrying any of the tags, so only their logs are scanned
+        if not u_id:
+            u_ids = ROLLUPS.tag_uids(app_name, tags, since, limit=TAG_INDEX_MAX_UIDS + 1)
+            if not u_ids:
+                return {"logs": [], "next_cursor": None}
+            if len(u_ids) <= TAG_INDEX_MAX_UIDS:
+                query["u_id"] = {"$in": u_ids}
+    if level:
+        query["level"] = level
+    if stage:
+        query["stage"] = stage
+    if u_id:
+        query["u_id"] = u_id
+
+    select_keys = [
+        "u_id",
+        "stage",
+        "level",
+        "status",
+        "duration",
+        "fingerprint",
+        "messages",
+        "tags",
+        "time",
+    ]
+
+    def at_time(timestamp):
+        # every log of the query at exactly timestamp, liteindex orders equal sort keys arbitrarily
+        return PARTITIONS.search(
+            app_name,
+            "logs",
+            query=dict(query, time=timestamp),
+            since=timestamp,
+            until=timestamp + 1,
+            select_keys=select_keys,
+        )
+
+    found = {}
+    if cursor_id:
+        found.update(
+            (_id, log) for _id, log in at_time(cursor_time).items() if _id < cursor_id
+        )
+
+    page = PARTITIONS.search(
+        app_name,
+        "logs",
+        query=query,
+        since=since,
+        until=query["time"].get("$lt"),
+        sort_by="time",
+        reversed_sort=True,
+        n=limit,
+        select_keys=select_keys,
+    )
+    found.update(page)
+    if len(page) == limit:
+        # the page may end part way through the logs of its oldest timestamp
+        found.update(at_time(min(log["time"] for log in page.values())))
+
+    logs = [
+        {
+            "id": _id,
+            "u_id": log["u_id"],
+            "stage": log["stage"],
+            "level": log["level"],
+            "status": log["status"],
+            "duration": log["duration"],
+            "fingerprint": log["fingerprint"],
+            "messages": log["messages"],
+            "tags": log["tags"],
+            "timestamp": log["time"],
+        }
+        for _id, log in sorted(
+            found.items(), key=lambda item: (item[1]["time"], item[0]), reverse=True
+        )[:limit]
+    ]
+
+    return {
+        "logs": logs,
+        "next_cursor": (
+            f"{logs[-1]['timestamp']!r}:{logs[-1]['id']}" if len(logs) == limit else None
+        ),
+    }
+
+
+def get_dash_columns(app_name, last_n_hours, long_running_n_hours=1, since_cursor=None):
+    # column arrays of uids, stage spans and metrics, for vectorized dashboards. Same rows as get_dash_metrics
+    # but read with plain sql, selecting only the charted columns (the first message instead of all of them
+    # and no tags) and without building per log dicts
+    now = time.time()
+    since = now - last_n_hours * 3600
+
+    if since_cursor is None:
+        u_id_filters = [("", ())]
+    else:
+        u_ids = get_updated_uids(app_name, since, since_cursor)
+        u_id_filters = [
+            (f" AND u_id IN ({', '.join('?' * len(chunk))})", tuple(chunk))
+            for chunk in (u_ids[i : i + 500] for i in range(0, len(u_ids), 500))
+        ]
+
+    # u_id: [first log time, last log time, {stage: [start, end]}, {stage: status}]
+    spans = {}
+    for u_id_filter, u_id_params in u_id_filters:
+        # partitions are read in time order, so rows stay sorted by time across them
+        for u_id, stage, log_time, first_message in PARTITIONS.execute(
+            app_name,
+            f"""SELECT u_id, stage, "time", json_extract(messages, '$[0]') FROM logs
+            WHERE app_name = ? AND "time" >= ?{u_id_filter}
+            ORDER BY "time"
+            """,
+            (app_name, since, *u_id_params),
+            since=since,
+        ):
+            if u_id not in spans:
+                spans[u_id] = [log_time, log_time, {}, {}]
+            span = spans[u_id]
+            span[1] = log_time
+
+            if stage is None:
+                continue
+
+            if stage not in span[2]:
+                span[2][stage] = [log_time, log_time]
+            span[2][stage][1] = log_time
+
+            if first_message == "Stage succeeded":
+                span[3][stage] = "success"
+            elif first_message == "Stage failed":
+                span[3][stage] = "failed"
+
+    uids = {
+        "u_id": [],
+        "start": [],
+        "end": [],
+        "success": [],
+        "failed": [],
+        "in_process": [],
+        "long_running": [],
+    }
+    stages = {"u_id": [], "stage": [], "start": [], "end": []}
+    for u_id, (start, end, stage_times, stage_status) in spans.items():
+        uids["u_id"].append(u_id)
+        uids["start"].append(start)
+        uids["end"].append(end)
+        status = uid_status(stage_status, len(stage_times), start, now, long_running_n_hours)
+        for flag in ("success", "failed", "in_process", "long_running"):
+            uids[flag].append(status[flag])
+
+        for stage, (stage_start, stage_end) in stage_times.items():
+            stages["u_id"].append(u_id)
+            stages["stage"].append(stage)
+            stages["start"].append(stage_start)
+            stages["end"].append(stage_end)
+
+    # only numeric values of uids with logs in the time range are charted
+    metrics = {"u_id": [], "metric": [], "value": [], "timestamp": [], "stage": []}
+    for u_id_filter, u_id_params in u_id_filters:
+        for u_id, key, num_value, timestamp, stage in PARTITIONS.execute(
+            app_name,
+            f"""SELECT u_id, "key", num_value, "timestamp", stage FROM key_value
+            WHERE app_name = ? AND "timestamp" >= ? AND num_value IS NOT NULL{u_id_filter}
+            ORDER BY "timestamp"
+            """,
+            (app_name, since, *u_id_params),
+            since=since,
+        ):
+            if u_id not in spans:
+                continue
+
+            metrics["u_id"].append(u_id)
+            metrics["metric"].append(key)
+            metrics["value"].append(num_value)
+            metrics["timestamp"].append(timestamp)
+            metrics["stage"].append(stage)
+
+    return {"uids": uids, "stages": stages, "metrics": metrics}
+
+
+_db_local = threading.local()
+
+
+def db_connection():
+    # plain sqlite connection to smartdash.db for the compactor
+    if getattr(_db_local, "connection", None) is None:
+        _db_local.connection = sqlite3.connect(db_path, timeout=30)
+
+    return _db_local.connection
+
+
+def get_dash_series(app_name, last_n_hours, max_points=500, max_series=20):
+    # per stage latency and per metric values downsampled into at most max_points time buckets,
+    # each with count, mean, min and max, for charts that stay bounded at any window size
+    since = time.time() - last_n_hours * 3600
+
+    first_times = [
+        first_time
+        for name, time_key in (("key_value", "timestamp"), ("logs", "time"))
+        for (first_time,) in PARTITIONS.execute(
+            app_name,
+            f'SELECT MIN("{time_key}") FROM "{name}" WHERE "{time_key}" >= ?',
+            (since,),
+            since=since,
+        )
+        if first_time is not None
+    ]
+    # eg: "All time" windows are narrowed to the data actually present
+    if first_times:
+        since = min(first_times)
+
+    bucket_seconds = max(60, math.ceil((time.time() - since) / max_points / 60) * 60)
+
+    key_counts = collections.Counter()
+    for key, count in PARTITIONS.execute(
+        app_name,
+        """SELECT "key", COUNT(*) FROM key_value WHERE "timestamp" >= ? AND num_value IS NOT NULL AND metric_type IS NULL
+        AND u_id NOT IN (?, ?) GROUP BY "key"
+        """,
+        (since, SAMPLING_U_ID, METRICS_U_ID),
+        since=since,
+    ):
+        key_counts[key] += count
+    top_keys = [key for key, _ in key_counts.most_common(max_series)]
+
+    # a time bucket can span two partitions, their partial count/sum/min/max are combined here
+    buckets = {}
+    for metric, bucket, count, total, min_, max_ in PARTITIONS.execute(
+        app_name,
+        f"""SELECT "key", CAST("timestamp" / ? AS INTEGER) AS bucket,
+        COUNT(num_value), SUM(num_value), MIN(num_value), MAX(num_value)
+        FROM key_value WHERE "timestamp" >= ? AND num_value IS NOT NULL AND metric_type IS NULL
+        AND u_id NOT IN (?, ?) AND "key" IN ({", ".join("?" for _ in top_keys)})
+        GROUP BY "key", bucket""",
+        (bucket_seconds, since, SAMPLING_U_ID, METRICS_U_ID, *top_keys),
+        since=since,
+    ):
+        if (metric, bucket) not in buckets:
+            buckets[(metric, bucket)] = [0, 0, min_, max_]
+        row = buckets[(metric, bucket)]
+        row[0] += count
+        row[1] += total
+        row[2] = min(row[2], min_)
+        row[3] = max(row[3], max_)
+
+    metrics = {"metric": [], "time": [], "count": [], "mean": [], "min": [], "max": []}
+    for (metric, bucket), (count, total, min_, max_) in sorted(buckets.items()):
+        metrics["metric"].append(metric)
+        metrics["time"].append(bucket * bucket_seconds)
+        metrics["count"].append(count)
+        metrics["mean"].append(total / count)
+        metrics["min"].append(min_)
+        metrics["max"].append(max_)
+
+    return {
+        "bucket_seconds": bucket_seconds,
+        "stages": ROLLUPS.stage_series(app_name, since, bucket_seconds),
+        "metrics": metrics,
+    }
+
+
+def get_metrics(
+    app_name, last_n_hours, max_points=500, quantiles=(0.5, 0.95, 0.99)
+):
+    # counter/gauge/histogram summaries combined into at most max_points time buckets per (metric, stage),
+    # value is the counter total, the last gauge value or the histogram mean of the bucket.
+    # Histogram percentiles are over the whole window, from the merged buckets of all summaries
+    now = time.time()
+    since = now - last_n_hours * 3600
+
+    summaries = PARTITIONS.search(
+        app_name,
+        "key_value",
+        query={"u_id": METRICS_U_ID, "timestamp": {"$gte": since}},
+        since=since,
+        sort_by="timestamp",
+        select_keys=[
+            "key",
+            "stage",
+            "timestamp",
+            "metric_type",
+            "count",
+            "sum",
+            "min",
+            "max",
+            "num_value",
+            "buckets",
+        ],
+    ).values()
+    summaries = [summary for summary in summaries if summary["metric_type"]]
+
+    if summaries:
+        since = max(since, summaries[0]["timestamp"])
+    bucket_seconds = max(1, math.ceil((now - since) / max_points))
+
+    # (metric_type, key, stage, time bucket): [count, sum, min, max, last]
+    buckets = {}
+    histograms = {}
+    for summary in summaries:
+        key = (
+            summary["metric_type"],
+            summary["key"],
+            summary["stage"],
+            int(summary["timestamp"] // bucket_seconds),
+        )
+        if key not in buckets:
+            buckets[key] = [0, 0, summary["min"], summary["max"], None]
+        row = buckets[key]
+        row[0] += summary["count"]
+        row[1] += summary["sum"]
+        row[2] = min(row[2], summary["min"])
+        row[3] = max(row[3], summary["max"])
+        row[4] = summary["num_value"]
+
+        if summary["buckets"]:
+            histogram = histograms.setdefault((summary["key"], summary["stage"]), {})
+            for bucket, count in summary["buckets"].items():
+                histogram[int(bucket)] = histogram.get(int(bucket), 0) + count
+
+    series = {
+        key: []
+        for key in (
+            "metric_type",
+            "metric",
+            "stage",
+            "time",
+            "count",
+            "sum",
+            "min",
+            "max",
+            "value",
+        )
+    }
+    # sorted by metric, stage and time, stage can be None
+    for (metric_type, metric, stage, bucket), row in sorted(
+        buckets.items(), key=lambda item: (item[0][:2], str(item[0][2]), item[0][3])
+    ):
+        count, total, min_, max_, last = row
+        series["metric_type"].append(metric_type)
+        series["metric"].append(metric)
+        series["stage"].append(stage)
+        series["time"].append(bucket * bucket_seconds)
+        series["count"].append(count)
+        series["sum"].append(total)
+        series["min"].append(min_)
+        series["max"].append(max_)
+        if metric_type == "counter":
+            series["value"].append(total)
+        elif metric_type == "gauge":
+            series["value"].append(last)
+        else:
+            series["value"].append(total / count)
+
+    return {
+        "bucket_seconds": bucket_seconds,
+        "series": series,
+        "percentiles": [
+            {
+                "metric": metric,
+                "stage": stage,
+                **sketch_quantiles(sorted(histogram.items()), quantiles),
+            }
+            for (metric, stage), histogram in histograms.items()
+        ],
+    }
+
+
+def get_blob(app_name, blob_id):
+    # the newest copy of a blob, a deduped blob sent again later is stored again in that later partition
+    blob = PARTITIONS.find(
+        app_name, "blobs", blob_id, select_keys=["data", "size", "timestamp"]
+    )
+    if blob is None:
+        return None
+
+    return {
+        "value": json.loads(blob["data"]),
+        "size": blob["size"],
+        "timestamp": blob["timestamp"],
+    }
+
+
+def parse_app_retention_days(value):
+    # "app1:7,app2:30" -> {"app1": 7.0, "app2": 30.0}
+    app_retention_days = {}
+    for item in value.split(","):
+        if item.strip():
+            app_name, days = item.rsplit(":", 1)
+            app_retention_days[app_name.strip()] = float(days)
+
+    return app_retention_days
+
+
+class Compactor(object):
+    # drops the partitions of raw logs and key values past their app's retention, deletes rollups past
+    # the rollup retention and the ids of logs rolled up more than dedup_days ago (see get_new_logs), then returns the pages freed in smartdash.db to the filesystem with an incremental vacuum.
+    # Runs in every worker, one pass at a time across workers
+    def __init__(
+        self,
+        interval,
+        retention_days,
+        app_retention_days,
+        rollup_retention_days,
+        dedup_days,
+        vacuum_pages,
+        batch_size,
+    ):
+        self.interval = interval
+        self.retention_days = retention_days
+        self.app_retention_days = app_retention_days
+        self.rollup_retention_days = rollup_retention_days
+        self.dedup_days = dedup_days
+        self.vacuum_pages = vacuum_pages
+        self.batch_size = batch_size
+        self.pid = None
+
+        # cumulative and last pass stats, shared by all workers
+        conn = sqlite3.connect(db_path)
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS compaction_stats (key TEXT PRIMARY KEY, value REAL)"
+            )
+        conn.close()
+
+    @property
+    def enabled(self):
+        return bool(
+            self.retention_days
+            or any(self.app_retention_days.values())
+            or self.rollup_retention_days
+            or self.dedup_days
+        )
+
+    def start(self):
+        if self.enabled and self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with open(f"{db_path}.compaction.lock", "w") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+
+                    # another worker's pass within the interval counts for this one too
+                    last_pass_at = get_compaction_stats().get("last_pass_at", 0)
+                    if time.time() - last_pass_at >= self.interval:
+                        self.run_once()
+            except Exception as ex:
+                print(f"smartdash compaction failed: {ex}")
+
+    def _vacuum(self):
+        conn = db_connection()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # incremental vacuum needs auto_vacuum=INCREMENTAL, new dbs are created with it (see Rollups),
+            # switching a db created before takes one full VACUUM
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            while conn.execute("PRAGMA freelist_count").fetchone()[0]:
+                conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+                time.sleep(0.01)
+
+        return (page_count - conn.execute("PRAGMA page_count").fetchone()[0]) * page_size
+
+    def run_once(self):
+        now = time.time()
+        n_deleted = 0
+        n_dropped = 0
+        reclaimed_bytes = 0
+
+        for app_name in get_app_names():
+            retention_days = self.app_retention_days.get(app_name, self.retention_days)
+            raw_before = now - retention_days * 86400 if retention_days else 0
+            rollup_before = (
+                now - self.rollup_retention_days * 86400
+                if self.rollup_retention_days
+                else 0
+            )
+
+            if raw_before:
+                n_partitions, n_bytes = PARTITIONS.drop_before(app_name, raw_before)
+                n_dropped += n_partitions
+                reclaimed_bytes += n_bytes
+                # the partition holding raw_before is kept whole, and so are its tag index and catalog rows
+                raw_before = PARTITIONS.partition_start(raw_before)
+            if raw_before or rollup_before:
+                n_deleted += ROLLUPS.expire(
+                    app_name, raw_before, rollup_before, self.batch_size
+                )
+
+        if self.dedup_days:
+            n_deleted += ROLLUPS.expire_rolled_up(
+                now - self.dedup_days * 86400, self.batch_size
+            )
+
+        reclaimed_bytes += self._vacuum()
+
+        with db_connection() as conn:
+            conn.executemany(
+                """INSERT INTO compaction_stats (key, value) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET value = value + excluded.value""",
+                [
+                    ("passes", 1),
+                    ("dropped_partitions", n_dropped),
+                    ("deleted_records", n_deleted),
+                    ("reclaimed_bytes", reclaimed_bytes),
+                ],
+            )
+            conn.executemany(
+                """INSERT INTO compaction_stats (key, value) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value""",
+                [
+                    ("last_pass_at", now),
+                    ("last_pass_seconds", time.time() - now),
+                    ("last_dropped_partitions", n_dropped),
+                    ("last_deleted_records", n_deleted),
+                    ("last_reclaimed_bytes", reclaimed_bytes),
+                ],
+            )
+
+        print(
+            f"smartdash compaction: dropped {n_dropped} partitions, deleted {n_deleted} rollup records, reclaimed {reclaimed_bytes} bytes in {time.time() - now:.1f}s"
+        )
+
+
+def get_compaction_stats():
+    return dict(
+        db_connection().execute("SELECT key, value FROM compaction_stats").fetchall()
+    )
+
+
+# raw logs and key values are kept SMARTDASH_RETENTION_DAYS (0 = forever), or per app with
+# SMARTDASH_APP_RETENTION_DAYS="app1:7,app2:30", rollups are kept SMARTDASH_ROLLUP_RETENTION_DAYS (0 = forever),
+# ids of rolled up logs SMARTDASH_ROLLUP_DEDUP_DAYS, the longest an upload is expected to be retried
+COMPACTOR = Compactor(
+    interval=float(os.getenv("SMARTDASH_COMPACTION_INTERVAL", 600)),
+    retention_days=float(os.getenv("SMARTDASH_RETENTION_DAYS", 0)),
+    app_retention_days=parse_app_retention_days(
+        os.getenv("SMARTDASH_APP_RETENTION_DAYS", "")
+    ),
+    rollup_retention_days=float(os.getenv("SMARTDASH_ROLLUP_RETENTION_DAYS", 0)),
+    dedup_days=float(os.getenv("SMARTDASH_ROLLUP_DEDUP_DAYS", 7)),
+    vacuum_pages=int(os.getenv("SMARTDASH_VACUUM_PAGES", 1000)),
+    batch_size=int(os.getenv("SMARTDASH_COMPACTION_BATCH_SIZE", 1000)),
+)
+
+
+class AppNames(object):
+    def on_get(self, req, resp):
+        resp.media = {"app_names": get_app_names()}
+        resp.status = falcon.HTTP_200
+
+
+class DashMetrics(object):
+    def on_get(self, req, resp):
+        app_name = req.get_param("app_name", required=True)
+        last_n_hours = float(req.get_param("last_n_hours", default=24))
+        long_running_n_hours = float(req.get_param("long_running_n_hours", default=1))
+        since_cursor = req.get_param("since_cursor")
+
+        cursor = time.time() - CURSOR_OVERLAP
+        args = (
+            app_name,
+            last_n_hours,
+            long_running_n_hours,
+            float(since_cursor) if since_cursor else None,
+        )
+
+        # format=columns returns column arrays instead of nested per uid records
+        if req.get_param("format") == "columns":
+            resp.media = {"columns": get_dash_columns(*args), "cursor": cursor}
+        else:
+            resp.media = {"data_by_uid": get_dash_metrics(*args), "cursor": cursor}
+        resp.status = falcon.HTTP_200
+
+
+class DashRollups(object):
+    def on_get(self, req, resp):
+        app_name = req.get_param("app_name", required=True)
+        since = time.time() - float(req.get_param("last_n_hours", default=24)) * 3600
+
+        resp.media = {
+            "stage_stats": ROLLUPS.stage_stats(app_name, since),
+            "status_counts": ROLLUPS.status_counts(app_name, since),
+        }
+        resp.status = falcon.HTTP_200
+
+
+class Catalog(object):
+    def on_get(self, req, resp):
+        app_name = req.get_param("app_name", required=True)
+        since = time.time() - float(req.get_param("last_n_hours", default=24)) * 3600
+
+        resp.media = ROLLUPS.catalog(app_name, since)
+        resp.status = falcon.HTTP_200
+
+
+class ExceptionGroups(object):
+    def on_get(self, req, resp):
+        app_name = req.get_param("app_name", required=True)
+        since = time.time() - float(req.get_param("last_n_hours", default=24)) * 3600
+        n = min(req.get_param_as_int("n", default=10), 1000)
+
+        resp.media = {"exception_groups": ROLLUPS.exception_groups(app_name, since, n)}
+        resp.status = falcon.HTTP_200
+
+
+class Metrics(object):
+    def on_get(self, req, resp):
+        resp.media = get_metrics(
+            req.get_param("app_name", required=True),
+            float(req.get_param("last_n_hours", default=24)),
+            max_points=min(req.get_param_as_int("max_points", default=500), 10000),
+        )
+        resp.status = falcon.HTTP_200
+
+
+class Blob(object):
+    def on_get(self, req, resp):
+        blob = get_blob(
+            req.get_param("app_name", required=True), req.get_param("id", required=True)
+        )
+        if blob is None:
+            raise falcon.HTTPNotFound(description="blob not found")
+
+        resp.media = blob
+        resp.status = falcon.HTTP_200
+
+
+class StagePercentiles(object):
+    def on_get(self, req, resp):
+        app_name = req.get_param("app_name", required=True)
+        since = time.time() - float(req.get_param("last_n_hours", default=24)) * 3600
+        quantiles = [
+            float(quantile)
+            for quantile in req.get_param("quantiles", default="0.5,0.95,0.99").split(",")
+        ]
+
+        resp.media = {
+            "percentiles": ROLLUPS.stage_percentiles(app_name, since, quantiles)
+        }
+        resp.status = falcon.HTTP_200
+
+
+class DashSeries(object):
+    def on_get(self, req, resp):
+        resp.media = get_dash_series(
+            req.get_param("app_name", required=True),
+            float(req.get_param("last_n_hours", default=24)),
+            max_points=min(req.get_param_as_int("max_points", default=500), 10000),
+            max_series=min(req.get_param_as_int("max_series", default=20), 1000),
+        )
+        resp.status = falcon.HTTP_200
+
+
+class Logs(object):
+    def on_get(self, req, resp):
+        since = req.get_param("since")
+        until = req.get_param("until")
+        cursor = req.get_param("cursor")
+
+        if not since:
+            since = time.time() - float(req.get_param("last_n_hours", default=24)) * 3600
+
+        resp.media = get_logs(
+            req.get_param("app_name", required=True),
+            since=float(since),
+            until=float(until) if until else None,
+            tags=req.get_param_as_list("tags"),
+            level=req.get_param("level"),
+            stage=req.get_param("stage"),
+            u_id=req.get_param("u_id"),
+            limit=min(req.get_param_as_int("limit", default=100), 10000),
+            cursor=cursor or None,
+        )
+        resp.status = falcon.HTTP_200
+
+
+class Prometheus(object):
+    def on_get(self, req, resp):
+        # prometheus text format, or openmetrics when the scraper asks for it
+        openmetrics = "application/openmetrics-text" in (req.get_header("Accept") or "")
+
+        INGEST_WRITER.observe_queue()
+        resp.text = PROMETHEUS.render(openmetrics=openmetrics)
+        resp.content_type = (
+            OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE
+        )
+        resp.status = falcon.HTTP_200
+
+
 class HealthCheck(object):
     def on_get(self, req, resp):
-        resp.media = {"status": "ok"}
+        resp.media = {
+            "status": "ok",
+            # the queue is only used by the worker currently leading ingest
+            "ingest_leader": INGEST_LEADER.is_leader,
+            "ingest_queue_depth": len(INGEST_WRITER.queue),
+            "ingest_queued_records": INGEST_WRITER.n_queued_records,
+            "compaction": get_compaction_stats(),
+        }
 
 
 class AddLogs(object):
     def on_post(self, req, resp):
-        LOG_INDEX.update(pickle.loads(req.stream.read()))
+        INGEST_LEADER.write("logs", read_batch(req))
 
         resp.media = {"success": True}
         resp.status = falcon.HTTP_200
@@ -64,12 +1589,40 @@ class AddLogs(object):
 
 class AddKeyValues(object):
     def on_post(self, req, resp):
-        KV_INDEX.update(pickle.loads(req.stream.read()))
+        INGEST_LEADER.write("key_value", read_batch(req))
 
         resp.media = {"success": True}
         resp.status = falcon.HTTP_200
 
 
+class StreamLogs(object):
+    def on_post(self, req, resp):
+        ingest_stream("logs", req, resp)
+
+
+class StreamKeyValues(object):
+    def on_post(self, req, resp):
+        ingest_stream("key_value", req, resp)
+
+
+class AddBlobs(object):
+    def on_post(self, req, resp):
+        INGEST_LEADER.write("blobs", read_batch(req))
+
+        resp.media = {"success": True}
+        resp.status = falcon.HTTP_200
+
+
+class StreamBlobs(object):
+    def on_post(self, req, resp):
+        ingest_stream("blobs", req, resp)
+
+
+def post_worker_init(worker):
+    COMPACTOR.start()
+    INGEST_LEADER.start()
+
+
 def main(port=8080):
     app = falcon.App(cors_enable=True)
     app.req_options.auto_parse_form_urlencoded = True
@@ -79,7 +1632,22 @@ def main(port=8080):
 
     app.add_route("/logs", AddLogs())
     app.add_route("/key_values", AddKeyValues())
+    app.add_route("/logs/stream", StreamLogs())
+    app.add_route("/key_values/stream", StreamKeyValues())
+    app.add_route("/blobs", AddBlobs())
+    app.add_route("/blobs/stream", StreamBlobs())
+    app.add_route("/app_names", AppNames())
+    app.add_route("/get_dash_metrics", DashMetrics())
+    app.add_route("/get_dash_rollups", DashRollups())
+    app.add_route("/get_catalog", Catalog())
+    app.add_route("/get_stage_percentiles", StagePercentiles())
+    app.add_route("/get_exception_groups", ExceptionGroups())
+    app.add_route("/get_logs", Logs())
+    app.add_route("/get_dash_series", DashSeries())
+    app.add_route("/get_metrics", Metrics())
+    app.add_route("/get_blob", Blob())
     app.add_route("/health", HealthCheck())
+    app.add_route("/metrics", Prometheus())
 
     import gunicorn.app.base
 
@@ -110,6 +1678,8 @@ def main(port=8080):
         "worker_connections": 1000,
         "worker_class": "gevent",
         "timeout": 120,
+        "post_worker_init": post_worker_init,
     }
 
+    PROMETHEUS.clear()
     StandaloneApplication(app, options).run()
@@ -1,8 +1,19 @@
 import os
+import re
 import sys
+import gzip
+import json
+import math
 import time
-import uuid
+import zlib
+import hashlib
+import atexit
+import sqlite3
+import threading
 import traceback
+import itertools
+import contextlib
+import collections
 from liteindex import DefinedIndex
 
 
@@ -18,19 +29,221 @@ def upload_to_smartdash():
     parser.add_argument(
         "--server_url", type=str, help="Smartdash server URL", required=True
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of db files synced in parallel",
+    )
+    parser.add_argument(
+        "--wire_format",
+        type=str,
+        default="columns",
+        choices=["columns", "frames", "pickle"],
+        help="columns (gzip compressed columnar json), frames (streamed to /logs/stream, /key_values/stream) or pickle for older servers",
+    )
+    parser.add_argument(
+        "--max_backlog",
+        type=int,
+        default=0,
+        help="Max unsynced records kept per db file while the server is unreachable, oldest are dropped beyond it (0 = unlimited)",
+    )
     args = parser.parse_args()
 
     print(f"Starting sync to {args.server_url}")
-    _upload_to_smartdash(args.save_dir, args.server_url)
+    _upload_to_smartdash(
+        args.save_dir,
+        args.server_url,
+        concurrency=args.concurrency,
+        max_backlog=args.max_backlog,
+        wire_format=args.wire_format,
+    )
+
+
+WIRE_CONTENT_TYPE = "application/vnd.smartdash.columns+json"
+PICKLE_CONTENT_TYPE = "application/vnd.smartdash.pickle"
+
+# low cardinality string columns sent as a per batch dictionary plus integer codes
+DICT_ENCODED_KEYS = {
+    "app_name",
+    "u_id",
+    "stage",
+    "level",
+    "status",
+    "key",
+    "name",
+    "tags",
+}
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def encode_batch(records):
+    ids = list(records)
+
+    keys = {}
+    for record in records.values():
+        keys.update(dict.fromkeys(record))
+
+    columns = {}
+    for key in keys:
+        values = [records[_id].get(key) for _id in ids]
+
+        if key not in DICT_ENCODED_KEYS:
+            columns[key] = values
+            continue
+
+        dictionary = {}
+        if key == "tags":
+            codes = [
+                [dictionary.setdefault(tag, len(dictionary)) for tag in tags]
+                if tags is not None
+                else None
+                for tags in values
+            ]
+        else:
+            codes = [dictionary.setdefault(value, len(dictionary)) for value in values]
+
+        columns[key] = {"dict": list(dictionary), "codes": codes}
+
+    return {"ids": ids, "columns": columns}
+
+
+def decode_batch(batch):
+    columns = {}
+    for key, column in batch["columns"].items():
+        if isinstance(column, dict):
+            dictionary = column["dict"]
+            if key == "tags":
+                column = [
+                    [dictionary[code] for code in codes] if codes is not None else None
+                    for codes in column["codes"]
+                ]
+            else:
+                column = [dictionary[code] for code in column["codes"]]
+
+        columns[key] = column
+
+    return {
+        _id: {key: column[i] for key, column in columns.items()}
+        for i, _id in enumerate(batch["ids"])
+    }
+
+
+def dumps_batch(records):
+    # values that are not json serializable (eg: other_value objects) are sent as their string form
+    return gzip.compress(
+        json.dumps(encode_batch(records), separators=(",", ":"), default=str).encode(),
+        compresslevel=5,
+    )
+
+
+def loads_batch(body):
+    return decode_batch(json.loads(gzip.decompress(body)))
 
 
-def _upload_to_smartdash(log_dir, url, batch_size=100):
+STREAM_CONTENT_TYPE = "application/vnd.smartdash.frames"
+
+
+def dumps_frames(records):
+    # one 4 byte length prefixed json [id, record] frame per record, so the server can decode incrementally
+    frames = []
+    for _id, record in records.items():
+        frame = json.dumps([_id, record], separators=(",", ":"), default=str).encode()
+        frames.append(len(frame).to_bytes(4, "big"))
+        frames.append(frame)
+
+    return gzip.compress(b"".join(frames), compresslevel=5)
+
+
+class _ServerBusy(Exception):
+    # 429 from the server (queue full, stream slots taken, no ingest leader), retried after its Retry-After
+    def __init__(self, retry_after):
+        super().__init__(f"server busy, retrying after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def _upload_to_smartdash(
+    log_dir, url, batch_size=100, concurrency=4, max_backlog=0, wire_format="columns"
+):
     import pickle
+    import random
     import requests
     from glob import glob
+    from concurrent.futures import ThreadPoolExecutor
+
+    # one keep-alive connection pool shared by all upload threads
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=concurrency, pool_maxsize=concurrency * 2
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def post(endpoint, data):
+        if wire_format == "columns":
+            response = session.post(
+                f"{url}/{endpoint}",
+                data=dumps_batch(data),
+                headers={
+                    "Content-Type": WIRE_CONTENT_TYPE,
+                    "Content-Encoding": "gzip",
+                },
+            )
+        elif wire_format == "frames":
+            response = session.post(
+                f"{url}/{endpoint}/stream",
+                data=dumps_frames(data),
+                headers={
+                    "Content-Type": STREAM_CONTENT_TYPE,
+                    "Content-Encoding": "gzip",
+                },
+            )
+        else:
+            response = session.post(
+                f"{url}/{endpoint}",
+                data=pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+                # accepted by newer servers only with SMARTDASH_ALLOW_PICKLE=1
+                headers={"Content-Type": PICKLE_CONTENT_TYPE},
+            )
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                # missing, or an http date
+                retry_after = float(os.getenv("SYNC_SLEEP", 10))
+            raise _ServerBusy(retry_after)
+
+        resp = response.json()
+        if not resp.get("success") == True:
+            raise Exception(f"server returned {resp}")
+
+        return len(data)
+
+    # db_file -> (consecutive failures, time of next attempt)
+    failures = {}
+
+    def read_batch(index, leased, batch_size):
+        batch = index.search(n=batch_size + len(leased))
+        return {k: batch[k] for k in batch if k not in leased}
 
     def upload_data(db_file, batch_size=512):
+        if time.time() < failures.get(db_file, (0, 0))[1]:
+            return 0
+
         name = os.path.splitext(os.path.basename(db_file))[0]
+        # per-process shards of a multiprocess logger ({name}.pid{pid}.db) are uploaded under the logger name
+        name = re.sub(r"\.pid\d+$", "", name)
 
         try:
             logs_index = DefinedIndex("logs", db_path=os.path.join(log_dir, db_file))
@@ -39,10 +252,21 @@ def _upload_to_smartdash(log_dir, url, batch_size=100):
                 "key_value", db_path=os.path.join(log_dir, db_file)
             )
         except:
-            return
+            return 0
 
-        total_n_logs_popped = 0
-        total_n_key_value_popped = 0
+        n_synced = {"logs": 0, "key_values": 0, "blobs": 0}
+        indexes = {"logs": logs_index, "key_values": key_value_index}
+
+        try:
+            # db files written by older smartloggers have no blobs index
+            blobs_index = DefinedIndex("blobs", db_path=os.path.join(log_dir, db_file))
+        except ValueError:
+            blobs_index = None
+        # servers old enough to need pickle have no /blobs route, blobs then stay in the local db
+        if blobs_index is not None and wire_format != "pickle":
+            indexes["blobs"] = blobs_index
+        # blobs can be up to max_blob_size each, they are sent a few at a time
+        batch_sizes = {"blobs": min(batch_size, 16)}
 
         logs_index_total_len = logs_index.count()
         key_value_index_total_len = key_value_index.count()
@@ -52,92 +276,677 @@ def _upload_to_smartdash(log_dir, url, batch_size=100):
                 f"smartlogger {name}: syncing {logs_index_total_len} logs, {key_value_index_total_len} key values"
             )
 
-        error_already_printed = False
+        start_time = time.time()
+        failed = False
+        retry_after = None
+        in_flight = {}
 
         while True:
-            logs_index_popped_data = logs_index.pop(n=batch_size)
+            # the next batches are read while the previous ones are still being posted,
+            # records in flight are leased and skipped until the server acknowledges them
+            next_batches = {
+                endpoint: read_batch(
+                    index,
+                    in_flight[endpoint][1] if endpoint in in_flight else {},
+                    batch_sizes.get(endpoint, batch_size),
+                )
+                for endpoint, index in indexes.items()
+            }
 
-            n_logs_popped = None
-            n_key_value_popped = None
+            for endpoint, (future, batch) in in_flight.items():
+                try:
+                    future.result()
+                    indexes[endpoint].delete(ids=list(batch))
+                    n_synced[endpoint] += len(batch)
+                except _ServerBusy as ex:
+                    retry_after = max(retry_after or 0, ex.retry_after)
+                    failed = True
+                except Exception as ex:
+                    if not failed:
+                        print(f"smartlogger {name}: error syncing {endpoint}: {ex}")
+                    failed = True
+
+            in_flight = {}
+
+            if failed or not any(next_batches.values()):
+                break
+
+            for endpoint, batch in next_batches.items():
+                if batch:
+                    for k in batch:
+                        batch[k]["app_name"] = name
+
+                    in_flight[endpoint] = (sender.submit(post, endpoint, batch), batch)
+
+        if not failed:
+            failures.pop(db_file, None)
+        elif retry_after is not None:
+            # backpressure rather than a failure, the server says when to come back
+            failures[db_file] = (failures.get(db_file, (0, 0))[0], time.time() + retry_after)
+            print(f"smartlogger {name}: server busy, retrying in {retry_after:.0f}s")
+        else:
+            n_failures = failures.get(db_file, (0, 0))[0] + 1
+            retry_in = min(
+                int(os.getenv("SYNC_SLEEP", 10)) * 2 ** (n_failures - 1),
+                int(os.getenv("SYNC_MAX_BACKOFF", 300)),
+            ) * random.uniform(0.5, 1)
+            failures[db_file] = (n_failures, time.time() + retry_in)
+
+            print(f"smartlogger {name}: retrying in {retry_in:.0f}s")
+
+        if failed and max_backlog:
+            for endpoint, index in indexes.items():
+                n_over = index.count() - max_backlog
+                if n_over > 0:
+                    index.pop(n=n_over)
+                    print(
+                        f"smartlogger {name}: dropped {n_over} oldest {endpoint} over max_backlog"
+                    )
 
-            if logs_index_popped_data:
-                n_logs_popped = len(logs_index_popped_data)
+        total_n_synced = sum(n_synced.values())
 
-                for k in logs_index_popped_data:
-                    logs_index_popped_data[k]["app_name"] = name
+        if total_n_synced:
+            time_taken = max(time.time() - start_time, 1e-6)
+            print(
+                f"smartlogger {name}: synced {n_synced['logs']} logs, {n_synced['key_values']} key values, {n_synced['blobs']} blobs ({total_n_synced / time_taken:.1f} records/sec)"
+            )
+            for index in indexes.values():
+                index.vaccum()
+
+        # a drained shard of a process that exited (eg: a recycled or restarted worker) is removed
+        shard_pid = re.search(r"\.pid(\d+)\.db$", db_file)
+        if (
+            not failed
+            and shard_pid
+            and not _is_alive(int(shard_pid.group(1)))
+            and not any(index.count() for index in indexes.values())
+            and not (blobs_index is not None and blobs_index.count())
+        ):
+            for path in (db_file, f"{db_file}-wal", f"{db_file}-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+            print(f"smartlogger {name}: removed drained shard {os.path.basename(db_file)}")
+
+        return total_n_synced
+
+    with ThreadPoolExecutor(max_workers=concurrency) as uploaders, ThreadPoolExecutor(
+        max_workers=concurrency * 2
+    ) as sender:
+        while True:
+            n_synced = sum(
+                uploaders.map(
+                    lambda db_file: upload_data(db_file, batch_size=batch_size),
+                    glob(os.path.join(log_dir, "*.db")),
+                )
+            )
 
-                try:
-                    resp = requests.post(
-                        f"{url}/logs",
-                        data=pickle.dumps(
-                            logs_index_popped_data, protocol=pickle.HIGHEST_PROTOCOL
-                        ),
-                    ).json()
+            # keep going without sleeping while there is a backlog to catch up on
+            if n_synced < batch_size:
+                time.sleep(int(os.getenv("SYNC_SLEEP", 10)))
 
-                    logs_index_popped_data = None
 
-                    if not resp["success"] == True:
-                        1 / 0
+# sqlite column types of the schema types that can be added to an existing index
+ADDABLE_COLUMN_TYPES = {"string": "TEXT", "number": "NUMBER", "json": "JSON"}
 
-                    error_already_printed = False
-                except Exception as ex:
-                    if not error_already_printed:
-                        print(f"smartlogger {name}: error syncing logs: {ex}")
-                        error_already_printed = True
 
-            key_value_index_popped_data = key_value_index.pop(n=batch_size)
+def _open_index(name, schema, db_path):
+    # keys appended to a schema after a db file was created are added to its table in place,
+    # so dbs written by older versions keep working
+    try:
+        return DefinedIndex(name, schema=schema, db_path=db_path)
+    except ValueError:
+        existing_schema = DefinedIndex(name, db_path=db_path).schema
+        if list(schema)[: len(existing_schema)] != list(existing_schema):
+            raise
 
-            if key_value_index_popped_data:
-                n_key_value_popped = len(key_value_index_popped_data)
+        with sqlite3.connect(db_path) as conn:
+            for key in list(schema)[len(existing_schema) :]:
+                conn.execute(
+                    f'ALTER TABLE "{name}" ADD COLUMN "{key}" {ADDABLE_COLUMN_TYPES[schema[key]]}'
+                )
+                conn.execute(
+                    f'INSERT INTO "__{name}_meta" (key, value_type) VALUES (?, ?)',
+                    (key, schema[key]),
+                )
 
-                for k in key_value_index_popped_data:
-                    key_value_index_popped_data[k]["app_name"] = name
+        return DefinedIndex(name, schema=schema, db_path=db_path)
 
-                try:
-                    resp = requests.post(
-                        f"{url}/key_values",
-                        data=pickle.dumps(
-                            key_value_index_popped_data,
-                            protocol=pickle.HIGHEST_PROTOCOL,
-                        ),
-                    ).json()
 
-                    key_value_index_popped_data = None
+class _Ids(object):
+    # monotonic 64 bit ids (milliseconds at start << 20 plus a counter) prefixed with a random per process node,
+    # unique across the processes and hosts uploading to one server and several times cheaper than uuid4
+    def __init__(self):
+        self.reset()
 
-                    if not resp["success"] == True:
-                        1 / 0
+    def reset(self):
+        self.node = os.urandom(6).hex()
+        self.counter = itertools.count(int(time.time() * 1000) << 20)
 
-                except Exception as ex:
-                    pass
+    def __call__(self):
+        return f"{self.node}{next(self.counter):016x}"
 
-            total_n_key_value_popped += n_key_value_popped if n_key_value_popped else 0
-            total_n_logs_popped += n_logs_popped if n_logs_popped else 0
 
-            if not n_logs_popped and not n_key_value_popped:
-                if total_n_logs_popped > 0 or total_n_key_value_popped > 0:
-                    print(
-                        f"smartlogger {name}: synced {total_n_logs_popped} logs, {total_n_key_value_popped} key values"
+_new_id = _Ids()
+
+if hasattr(os, "register_at_fork"):
+    # a forked child continuing its parent's counter would reuse its ids
+    os.register_at_fork(after_in_child=_new_id.reset)
+
+
+def _to_str(message):
+    # a message whose __str__ raises is logged as its repr instead of failing the whole flush
+    try:
+        return str(message)
+    except Exception:
+        try:
+            return repr(message)
+        except Exception:
+            return f"<unprintable {type(message).__name__}>"
+
+
+class _LogRecord(object):
+    # compact records are buffered until they are written, messages are converted to strings only then
+    __slots__ = (
+        "id",
+        "u_id",
+        "stage",
+        "level",
+        "messages",
+        "time",
+        "tags",
+        "duration",
+        "status",
+        "fingerprint",
+        "traceback",
+    )
+    index = "logs_index"
+
+    def __init__(
+        self,
+        u_id,
+        stage,
+        level,
+        messages,
+        time,
+        tags,
+        duration,
+        status,
+        fingerprint=None,
+        traceback=None,
+    ):
+        self.id = _new_id()
+        self.u_id = u_id
+        self.stage = stage
+        self.level = level
+        self.messages = messages
+        self.time = time
+        self.tags = tags
+        self.duration = duration
+        self.status = status
+        self.fingerprint = fingerprint
+        self.traceback = traceback
+
+    def to_dict(self):
+        return {
+            "u_id": self.u_id,
+            "stage": self.stage,
+            "level": self.level,
+            "messages": [_to_str(m) for m in self.messages],
+            "time": self.time,
+            "tags": list(self.tags),
+            "duration": self.duration,
+            "status": self.status,
+            "fingerprint": self.fingerprint,
+            "traceback": self.traceback,
+        }
+
+
+class _KeyValueRecord(object):
+    __slots__ = (
+        "id",
+        "u_id",
+        "key",
+        "num_value",
+        "str_value",
+        "other_value",
+        "name",
+        "timestamp",
+        "stage",
+        "tags",
+        "blob",
+        "blob_size",
+    )
+    index = "key_value_index"
+    # sampled like the DEBUG/INFO logs of their uid
+    level = "KEY_VALUE"
+
+    def __init__(
+        self,
+        u_id,
+        key,
+        num_value,
+        str_value,
+        other_value,
+        name,
+        timestamp,
+        stage,
+        tags,
+        blob=None,
+        blob_size=None,
+    ):
+        self.id = _new_id()
+        self.u_id = u_id
+        self.key = key
+        self.num_value = num_value
+        self.str_value = str_value
+        self.other_value = other_value
+        self.name = name
+        self.timestamp = timestamp
+        self.stage = stage
+        self.tags = tags
+        self.blob = blob
+        self.blob_size = blob_size
+
+    def to_dict(self):
+        return {
+            "u_id": self.u_id,
+            "key": self.key,
+            "num_value": self.num_value,
+            "str_value": self.str_value,
+            "other_value": self.other_value,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "stage": self.stage,
+            "tags": list(self.tags),
+            "blob": self.blob,
+            "blob_size": self.blob_size,
+        }
+
+
+class _BlobRecord(object):
+    # a large key value payload as json, stored once per content hash when dedup is on
+    __slots__ = ("id", "u_id", "stage", "data", "timestamp")
+    index = "blobs_index"
+    # sampled (held, kept) together with the key value referencing it
+    level = "KEY_VALUE"
+
+    def __init__(self, _id, u_id, stage, data, timestamp):
+        self.id = _id
+        self.u_id = u_id
+        self.stage = stage
+        self.data = data
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {
+            "data": self.data,
+            "size": len(self.data),
+            "timestamp": self.timestamp,
+        }
+
+
+# u_id of the key values summarizing counters, gauges and histograms
+METRICS_U_ID = "__metrics__"
+
+# histogram buckets are the logarithmic buckets of the smartdash latency sketch (1% relative accuracy),
+# values below HISTOGRAM_MIN_VALUE (including zero and negative values) fall in its bucket
+HISTOGRAM_GAMMA = 1.01 / 0.99
+HISTOGRAM_MIN_VALUE = 1e-6
+
+
+def histogram_bucket(value):
+    return math.ceil(math.log(max(value, HISTOGRAM_MIN_VALUE), HISTOGRAM_GAMMA))
+
+
+class _MetricRecord(object):
+    # summary of one counter/gauge/histogram over one interval, num_value is the counter total,
+    # the last gauge value or the histogram mean so it charts like any other numeric key value
+    __slots__ = (
+        "id",
+        "metric_type",
+        "key",
+        "stage",
+        "tags",
+        "timestamp",
+        "count",
+        "sum",
+        "min",
+        "max",
+        "last",
+        "buckets",
+    )
+    index = "key_value_index"
+    u_id = METRICS_U_ID
+    level = "KEY_VALUE"
+
+    def __init__(self, metric_type, key, stage, tags, timestamp, aggregate):
+        self.id = _new_id()
+        self.metric_type = metric_type
+        self.key = key
+        self.stage = stage
+        self.tags = tags
+        self.timestamp = timestamp
+        self.count, self.sum, self.min, self.max, self.last, self.buckets = aggregate
+
+    def to_dict(self):
+        if self.metric_type == "counter":
+            num_value = self.sum
+        elif self.metric_type == "gauge":
+            num_value = self.last
+        else:
+            num_value = self.sum / self.count
+
+        return {
+            "u_id": METRICS_U_ID,
+            "key": self.key,
+            "num_value": num_value,
+            "name": None,
+            "timestamp": self.timestamp,
+            "stage": self.stage,
+            "tags": list(self.tags),
+            "metric_type": self.metric_type,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "buckets": self.buckets,
+        }
+
+
+class _Metrics(object):
+    # counters, gauges and histograms are aggregated in memory per (type, key, stage, tags, interval)
+    # and written as one summary record per interval once it has ended, instead of one row per call
+    def __init__(self, interval):
+        self.interval = interval
+        # (type, key, stage, tags, interval start): [count, sum, min, max, last, {bucket: count} or None]
+        self.aggregates = {}
+        self.started = None
+        self.lock = threading.Lock()
+
+    def add(self, metric_type, key, value, stage, tags):
+        # the summaries of the intervals that ended before this one, to write now
+        now = time.time()
+        start = now - now % self.interval
+        aggregate_key = (metric_type, key, stage, tags, start)
+
+        with self.lock:
+            # the first value of an interval ends the previous ones
+            due = self._take_ended(start)
+
+            aggregate = self.aggregates.get(aggregate_key)
+            if aggregate is None:
+                aggregate = self.aggregates[aggregate_key] = [
+                    0,
+                    0,
+                    value,
+                    value,
+                    value,
+                    {} if metric_type == "histogram" else None,
+                ]
+
+            aggregate[0] += 1
+            aggregate[1] += value
+            if value < aggregate[2]:
+                aggregate[2] = value
+            if value > aggregate[3]:
+                aggregate[3] = value
+            aggregate[4] = value
+
+            if aggregate[5] is not None:
+                bucket = histogram_bucket(value)
+                aggregate[5][bucket] = aggregate[5].get(bucket, 0) + 1
+
+        return due
+
+    def take_ended(self):
+        # summaries of the intervals that have ended, cheap while the current interval hasn't changed
+        now = time.time()
+        start = now - now % self.interval
+        if start == self.started:
+            return []
+
+        with self.lock:
+            return self._take_ended(start)
+
+    def _take_ended(self, start):
+        if start == self.started:
+            return []
+
+        self.started = start
+        return self._take(before=start)
+
+    def take(self, before=None):
+        # summaries of the intervals started before `before`, or of all of them
+        with self.lock:
+            return self._take(before)
+
+    def _take(self, before):
+        records = []
+        for aggregate_key in list(self.aggregates):
+            metric_type, key, stage, tags, start = aggregate_key
+            if before is None or start < before:
+                records.append(
+                    _MetricRecord(
+                        metric_type,
+                        key,
+                        stage,
+                        tags,
+                        start,
+                        self.aggregates.pop(aggregate_key),
                     )
-                    logs_index.vaccum()
-                    key_value_index.vaccum()
-                return
+                )
+
+        return records
+
+
+def exception_fingerprint(exc_type, exc_traceback):
+    # exception type plus the file, line and function of every frame, computed without formatting or reading sources
+    locations = [f"{exc_type.__module__}.{exc_type.__qualname__}"]
+    while exc_traceback is not None:
+        code = exc_traceback.tb_frame.f_code
+        locations.append(f"{code.co_filename}:{exc_traceback.tb_lineno}:{code.co_name}")
+        exc_traceback = exc_traceback.tb_next
+
+    return hashlib.blake2b("\n".join(locations).encode(), digest_size=8).hexdigest()
+
+
+TRACEBACK_RESEND_INTERVAL = 600
+
+# u_id of the key values counting sampled out and rate limited records
+SAMPLING_U_ID = "__smartlogger__"
+
+
+class _Sampler(object):
+    # DEBUG/INFO logs and key values are kept for the uids whose crc32 falls within sample_rate, deterministic
+    # across processes. Records of the other uids are held, at most hold_size of them with the oldest uids evicted
+    # first, and written if the uid logs an error/exception/failed stage (tail based), otherwise they are counted
+    # as sampled out. Stage ends (records with a status) are never sampled, the server rolls up success rates and
+    # latencies from them. rate_limits {level: records/sec} are token buckets applied before sampling
+    def __init__(self, sample_rate, hold_size, rate_limits, count_interval=10):
+        self.sample_rate = sample_rate
+        self.rate_limits = rate_limits
+        self.threshold = int(sample_rate * 2**32)
+        self.hold_size = hold_size
+        self.count_interval = count_interval
+
+        # level: [records/sec, tokens, last refill]
+        self.buckets = {
+            level: [rate, rate, time.monotonic()] for level, rate in rate_limits.items()
+        }
 
-    while True:
-        for db_file in glob(os.path.join(log_dir, "*.db")):
-            upload_data(db_file, batch_size=batch_size)
+        self.held = collections.OrderedDict()
+        self.n_held = 0
+        self.kept_uids = collections.OrderedDict()
+        # (key, level, stage): n records not written
+        self.counts = collections.Counter()
+        self.counted_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def fresh(self):
+        # same settings, nothing held or counted and a new lock, for a forked child
+        return _Sampler(
+            self.sample_rate, self.hold_size, self.rate_limits, self.count_interval
+        )
 
-        time.sleep(int(os.getenv("SYNC_SLEEP", 10)))
+    def _allow(self, level):
+        bucket = self.buckets.get(level)
+        if bucket is None:
+            return True
+
+        now = time.monotonic()
+        bucket[1] = min(bucket[0], bucket[1] + (now - bucket[2]) * bucket[0])
+        bucket[2] = now
+        if bucket[1] < 1:
+            return False
+
+        bucket[1] -= 1
+        return True
+
+    def filter(self, record):
+        # the records to write now in place of record: none, record, or the uid's held records and record
+        with self.lock:
+            if not self._allow(record.level):
+                self.counts[("smartlogger.rate_limited", record.level, record.stage)] += 1
+                return self._due_counts()
+
+            if record.level in ("ERROR", "EXCEPTION"):
+                self.kept_uids[record.u_id] = True
+                if len(self.kept_uids) > self.hold_size:
+                    self.kept_uids.popitem(last=False)
+
+                held = self.held.pop(record.u_id, [])
+                self.n_held -= len(held)
+                return held + [record] + self._due_counts()
+
+            if (
+                record.level not in ("DEBUG", "INFO", "KEY_VALUE")
+                or getattr(record, "status", None) is not None
+                or record.u_id in self.kept_uids
+                or zlib.crc32(record.u_id.encode()) < self.threshold
+            ):
+                return [record] + self._due_counts()
+
+            if record.u_id not in self.held:
+                self.held[record.u_id] = []
+            self.held[record.u_id].append(record)
+            self.n_held += 1
+
+            while self.n_held > self.hold_size:
+                self._evict()
+
+            return self._due_counts()
+
+    def _evict(self):
+        _, evicted = self.held.popitem(last=False)
+        self.n_held -= len(evicted)
+        for record in evicted:
+            self.counts[("smartlogger.sampled_out", record.level, record.stage)] += 1
+
+    def _due_counts(self):
+        if time.monotonic() - self.counted_at < self.count_interval:
+            return []
+
+        return self.take_counts()
+
+    def take_counts(self):
+        # counts since the last call as key values, name is the level, so totals can be extrapolated
+        self.counted_at = time.monotonic()
+
+        counts = self.counts
+        self.counts = collections.Counter()
+
+        return [
+            _KeyValueRecord(
+                SAMPLING_U_ID, key, n, None, None, level, time.time(), stage, ()
+            )
+            for (key, level, stage), n in counts.items()
+        ]
 
 
 class SmartLogger:
-    def __init__(self, name, dir="./", log_to_console=False):
+    def __init__(
+        self,
+        name,
+        dir="./",
+        log_to_console=False,
+        async_mode=False,
+        buffer_size=100000,
+        flush_interval=1,
+        flush_size=1024,
+        on_full="drop",
+        multiprocess=False,
+        sample_rate=1.0,
+        sample_hold_size=10000,
+        rate_limits=None,
+        metrics_interval=10,
+        blob_min_size=1024,
+        max_blob_size=1024 * 1024,
+        dedup_blobs=True,
+    ):
+        if on_full not in {"drop", "block"}:
+            raise ValueError("on_full must be one of drop, block")
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+
         self.name = name
         self.log_to_console = log_to_console
+        self.async_mode = async_mode
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.on_full = on_full
+        self.n_dropped = 0
+        self.dir = dir
+        self.multiprocess = multiprocess
+        self.metrics_interval = metrics_interval
+        self.blob_min_size = blob_min_size
+        self.max_blob_size = max_blob_size
+        self.dedup_blobs = dedup_blobs
+
+        self._metrics = _Metrics(metrics_interval)
+
+        # exception fingerprint: monotonic time its traceback was last logged
+        self._traceback_sent_at = {}
+
+        # records of batch stages dropped without being ended, written with the next records, flush or at exit
+        self._orphaned = collections.deque()
+
+        # sampling is off unless a sample_rate below 1 or rate_limits are given
+        self._sampler = (
+            _Sampler(sample_rate, sample_hold_size, rate_limits or {})
+            if sample_rate < 1 or rate_limits
+            else None
+        )
 
         os.makedirs(dir, exist_ok=True)
-        db_path = os.path.join(dir, f"{self.name}.db")
+        self._open_indexes()
+
+        self._local = threading.local()
 
-        self.logs_index = DefinedIndex(
+        if self.async_mode:
+            self._start_flusher()
+            atexit.register(self.flush)
+
+        if self._sampler is not None:
+            # runs before the atexit flush registered above
+            atexit.register(self._write_sampling_counts)
+
+        atexit.register(self._write_metrics)
+        atexit.register(self._write_orphaned)
+
+        # sqlite connections and the flusher thread don't survive a fork (eg: gunicorn with preload),
+        # the child reopens them whatever the mode
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _open_indexes(self):
+        # in multiprocess mode every process writes to its own shard, so workers never share a sqlite write lock
+        if self.multiprocess:
+            db_path = os.path.join(self.dir, f"{self.name}.pid{os.getpid()}.db")
+        else:
+            db_path = os.path.join(self.dir, f"{self.name}.db")
+
+        self.logs_index = _open_index(
             "logs",
             schema={
                 "u_id": "string",
@@ -146,11 +955,17 @@ class SmartLogger:
                 "messages": "json",
                 "time": "number",
                 "tags": "json",
+                # set on the last log of a stage by success()/failed()
+                "duration": "number",
+                "status": "string",
+                # set by exception(), the traceback only on the first log of each fingerprint
+                "fingerprint": "string",
+                "traceback": "string",
             },
             db_path=db_path,
         )
 
-        self.key_value_index = DefinedIndex(
+        self.key_value_index = _open_index(
             "key_value",
             schema={
                 "u_id": "string",
@@ -162,28 +977,250 @@ class SmartLogger:
                 "timestamp": "number",
                 "stage": "string",
                 "tags": "json",
+                # set by counter()/gauge()/histogram() summaries, buckets {histogram bucket: count}
+                "metric_type": "string",
+                "count": "number",
+                "sum": "number",
+                "min": "number",
+                "max": "number",
+                "buckets": "json",
+                # id and size of a value sent through the blobs index, blob is None if it was over max_blob_size
+                "blob": "string",
+                "blob_size": "number",
             },
             db_path=db_path,
         )
 
-    def _log(self, id, level, *messages, stage=None, tags=[]):
+        self.blobs_index = _open_index(
+            "blobs",
+            schema={"data": "string", "size": "number", "timestamp": "number"},
+            db_path=db_path,
+        )
+
+    def _start_flusher(self):
+        self._buffer = collections.deque()
+        self._buffer_condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _after_fork(self):
+        # a forked worker (eg: gunicorn with preload) gets its own connections (and shard in multiprocess mode),
+        # a fresh buffer and a flusher thread, records buffered by the parent stay with the parent
+        self._open_indexes()
+        self._local = threading.local()
+        # values aggregated, records held or orphaned by the parent are written by the parent, and locks
+        # that another parent thread held at fork time would never be released in the child
+        self._metrics = _Metrics(self.metrics_interval)
+        self._orphaned = collections.deque()
+        if self._sampler is not None:
+            self._sampler = self._sampler.fresh()
+
+        if self.async_mode:
+            self._start_flusher()
+
+    def _write_sampling_counts(self):
+        # at exit, records still held for uids that didn't fail are sampled out
+        with self._sampler.lock:
+            while self._sampler.held:
+                self._sampler._evict()
+            records = self._sampler.take_counts()
+
+        for record in records:
+            self._write_one(record)
+
+    def _write_metrics(self):
+        # at exit, the summaries of intervals that haven't ended yet are written too
+        for record in self._metrics.take():
+            self._write_one(record)
+
+    def _take_orphaned(self):
+        records = []
+        while True:
+            try:
+                records.append(self._orphaned.popleft())
+            except IndexError:
+                return records
+
+    def _write_orphaned(self):
+        if self._orphaned:
+            self._commit(self._take_orphaned())
+
+    def _write(self, record):
+        # without a flusher, summaries of ended intervals go out with the next record of any kind
+        if not self.async_mode:
+            for metric_record in self._metrics.take_ended():
+                self._write_one(metric_record)
+
+        if self._sampler is None:
+            self._write_one(record)
+        else:
+            for record in self._sampler.filter(record):
+                self._write_one(record)
+
+    def _write_one(self, record):
+        if self._orphaned and not self.async_mode:
+            self._write_orphaned()
+
+        pending = getattr(self._local, "pending", None)
+
+        if pending is not None:
+            pending.append(record)
+        elif self.async_mode:
+            self._enqueue(record)
+        else:
+            getattr(self, record.index).update({record.id: record.to_dict()})
+
+    def _enqueue(self, record):
+        with self._buffer_condition:
+            while len(self._buffer) >= self.buffer_size:
+                if self.on_full == "drop":
+                    self.n_dropped += 1
+                    return
+                self._buffer_condition.wait()
+
+            self._buffer.append(record)
+
+            if len(self._buffer) >= self.flush_size:
+                self._buffer_condition.notify_all()
+
+    def _commit(self, records):
+        if self.async_mode:
+            for record in records:
+                self._enqueue(record)
+        else:
+            self._write_many(records)
+
+    def _write_many(self, records):
+        batches = {}
+        for record in records:
+            if record.index not in batches:
+                batches[record.index] = {}
+            batches[record.index][record.id] = record.to_dict()
+
+        for index, batch in batches.items():
+            getattr(self, index).update(batch)
+
+    @contextlib.contextmanager
+    def batch(self):
+        # nested batches on the same thread are committed by the outermost one
+        if getattr(self._local, "pending", None) is not None:
+            yield self
+            return
+
+        self._local.pending = []
+        try:
+            yield self
+        finally:
+            pending = self._local.pending
+            self._local.pending = None
+            self._commit(pending)
+
+    @contextlib.contextmanager
+    def _collect_into(self, pending):
+        previous = getattr(self._local, "pending", None)
+
+        if pending is None or previous is not None:
+            yield
+            return
+
+        self._local.pending = pending
+        try:
+            yield
+        finally:
+            self._local.pending = None
+
+    def _flush_loop(self):
+        while True:
+            with self._buffer_condition:
+                if len(self._buffer) < self.flush_size:
+                    self._buffer_condition.wait(self.flush_interval)
+
+            try:
+                # summaries of ended intervals are written even if no more values come in,
+                # with the batch instead of through the buffer, which may be full
+                self._flush(self._metrics.take_ended())
+            except Exception as ex:
+                print(f"smartlogger {self.name}: error flushing logs: {ex}")
+
+    def flush(self):
+        if not self.async_mode:
+            return
+
+        self._flush()
+
+    def _flush(self, records=[]):
+        # flush_lock makes the atexit flush wait for a flush already in progress on the flusher thread
+        with self._flush_lock:
+            with self._buffer_condition:
+                buffered = list(self._buffer)
+                self._buffer.clear()
+                self._buffer_condition.notify_all()
+            buffered += self._take_orphaned()
+            buffered += records
+
+            try:
+                self._write_many(buffered)
+            except Exception:
+                self._write_each(buffered)
+
+    def _write_each(self, records):
+        # one record at a time after a failed batch, so one bad record doesn't lose the others.
+        # While the db is locked or busy the unwritten records go back to the buffer for the next flush,
+        # other errors (eg: no such table) would fail the same way on every retry, their record is dropped
+        for i, record in enumerate(records):
+            try:
+                getattr(self, record.index).update({record.id: record.to_dict()})
+            except sqlite3.OperationalError as ex:
+                if "locked" not in str(ex) and "busy" not in str(ex):
+                    self.n_dropped += 1
+                    print(f"smartlogger {self.name}: dropped a record that can't be written: {ex}")
+                    continue
+
+                with self._buffer_condition:
+                    self._buffer.extendleft(reversed(records[i:]))
+                print(
+                    f"smartlogger {self.name}: {len(records) - i} records kept for the next flush: {ex}"
+                )
+                return
+            except Exception as ex:
+                self.n_dropped += 1
+                print(f"smartlogger {self.name}: dropped a record that can't be written: {ex}")
+
+    def _log(
+        self,
+        id,
+        level,
+        *messages,
+        stage=None,
+        tags=[],
+        duration=None,
+        status=None,
+        fingerprint=None,
+        traceback_string=None,
+    ):
         timestamp = time.time()
 
-        self.logs_index.update(
-            {
-                str(uuid.uuid4()): {
-                    "u_id": str(id),
-                    "stage": stage,
-                    "level": level,
-                    "messages": [str(m) for m in messages],
-                    "time": timestamp,
-                    "tags": tags,
-                }
-            }
+        self._write(
+            _LogRecord(
+                str(id),
+                stage,
+                level,
+                messages,
+                timestamp,
+                tags,
+                duration,
+                status,
+                fingerprint,
+                traceback_string,
+            )
         )
 
         if self.log_to_console:
             self._print_to_console(timestamp, id, level, messages, stage, tags)
+            if traceback_string is not None:
+                print(traceback_string, end="")
 
     def _print_to_console(self, timestamp, id, level, messages, stage, tags=[]):
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
@@ -199,9 +1236,9 @@ class SmartLogger:
 
         formatted_message = f"{log_colors[level]}{timestamp} {id} {stage_color}{stage}: {level}: {reset_color}"
         for message in messages:
-            formatted_message += f"{message} "
+            formatted_message += f"{_to_str(message)} "
 
-        formatted_message += f"tags: {tags}"
+        formatted_message += f"tags: {list(tags)}"
 
         print(formatted_message)
 
@@ -218,88 +1255,226 @@ class SmartLogger:
         self._log(id, "ERROR", *messages, stage=stage, tags=tags)
 
     def exception(self, id, *messages, stage=None, tags=[]):
-        exc_info = sys.exc_info()
-        traceback_string = "".join(traceback.format_exception(*exc_info))
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        if exc_type is None:
+            self._log(id, "EXCEPTION", *messages, stage=stage, tags=tags)
+            return
+
+        # occurrences are grouped by fingerprint, the traceback is formatted and stored only with the first one
+        # (and again every TRACEBACK_RESEND_INTERVAL seconds in case it was dropped or expired on the server)
+        fingerprint = exception_fingerprint(exc_type, exc_traceback)
+        now = time.monotonic()
+        traceback_string = None
+        if (
+            now - self._traceback_sent_at.get(fingerprint, -TRACEBACK_RESEND_INTERVAL)
+            >= TRACEBACK_RESEND_INTERVAL
+        ):
+            if len(self._traceback_sent_at) >= 10000:
+                self._traceback_sent_at.clear()
+            self._traceback_sent_at[fingerprint] = now
+            traceback_string = "".join(
+                traceback.format_exception(exc_type, exc_value, exc_traceback)
+            )
 
-        messages = (
-            f"\nException Info: {exc_info}",
-            f"\nTraceback:\n{traceback.format_exception(*exc_info)}",
+        self._log(
+            id,
+            "EXCEPTION",
+            f"{exc_type.__name__}: {exc_value}",
             *messages,
+            stage=stage,
+            tags=tags,
+            fingerprint=fingerprint,
+            traceback_string=traceback_string,
         )
-        self._log(id, "EXCEPTION", *messages, stage=stage, tags=tags)
 
     def key_value(self, id, key, value, name=None, stage=None, tags=[]):
+        timestamp = time.time()
         num_value = value if isinstance(value, (int, float)) else None
         str_value = value if isinstance(value, str) else None
-        other_value = value if not num_value and not str_value else None
-        self.key_value_index.update(
-            {
-                str(uuid.uuid4()): {
-                    "u_id": str(id),
-                    "key": key,
-                    "num_value": num_value,
-                    "str_value": str_value,
-                    "other_value": other_value,
-                    "name": name,
-                    "timestamp": time.time(),
-                    "stage": stage,
-                    "tags": tags,
-                }
-            }
+        other_value = value if num_value is None and str_value is None else None
+        blob, blob_size = None, None
+
+        if other_value is not None:
+            # other values of at least blob_min_size bytes as json go to the blobs index, once per content
+            # hash with dedup_blobs, values over max_blob_size are only recorded by their size
+            data = json.dumps(other_value, separators=(",", ":"), default=str)
+            if len(data) >= self.blob_min_size:
+                other_value = None
+                blob_size = len(data)
+
+                if blob_size <= self.max_blob_size:
+                    blob = (
+                        hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+                        if self.dedup_blobs
+                        else _new_id()
+                    )
+                    self._write(_BlobRecord(blob, str(id), stage, data, timestamp))
+
+        self._write(
+            _KeyValueRecord(
+                str(id),
+                key,
+                num_value,
+                str_value,
+                other_value,
+                name,
+                timestamp,
+                stage,
+                tags,
+                blob,
+                blob_size,
+            )
         )
 
-    def Stage(self, id, stage_name, tags=[]):
+    def _metric(self, metric_type, key, value, stage, tags):
+        # summaries skip sampling, they already stand for every value of the interval
+        for record in self._metrics.add(metric_type, key, value, stage, tuple(tags)):
+            self._write_one(record)
+
+    def counter(self, key, value=1, stage=None, tags=[]):
+        self._metric("counter", key, value, stage, tags)
+
+    def gauge(self, key, value, stage=None, tags=[]):
+        self._metric("gauge", key, value, stage, tags)
+
+    def histogram(self, key, value, stage=None, tags=[]):
+        self._metric("histogram", key, value, stage, tags)
+
+    def Stage(self, id, stage_name, tags=[], batch=False):
         return self.StageConstructor(
-            parent_logger=self, id=id, stage=stage_name, tags=tags
+            parent_logger=self, id=id, stage=stage_name, tags=tags, batch=batch
         )
 
     class StageConstructor:
-        def __init__(self, parent_logger, id, stage, tags=[]):
+        def __init__(self, parent_logger, id, stage, tags=[], batch=False):
             self.parent_logger = parent_logger
             self.id = str(id)
-            self.stage = stage
-            self.tags = tags
-            self.parent_logger.info(id, "Stage started", stage=stage, tags=tags)
+            self.stage = sys.intern(stage) if isinstance(stage, str) else stage
+            # interned once, records of the stage share this tuple unless a call adds tags of its own
+            self.tags = tuple(
+                sys.intern(tag) if isinstance(tag, str) else tag for tag in tags
+            )
+            # with batch=True, all records of the stage are written in one update when it ends
+            self._pending = [] if batch else None
+            self._ended = False
+
+            with self._collect():
+                self.parent_logger.info(
+                    self.id, "Stage started", stage=self.stage, tags=self.tags
+                )
+
+            self._start = time.perf_counter()
+
+        def __del__(self):
+            # a batch stage dropped without being ended hands its records to the logger instead of losing them,
+            # no locks or writes here since the garbage collector can run this on any thread at any time
+            pending = getattr(self, "_pending", None)
+            if pending:
+                self.parent_logger._orphaned.extend(pending)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, exc_traceback):
+            # a stage used as a context manager is marked failed if the block raises, succeeded otherwise
+            if not self._ended:
+                if exc_type is None:
+                    self.success()
+                else:
+                    self.exception()
+                    self.failed()
+
+            return False
+
+        def _end(self, level, message, status, tags):
+            duration = time.perf_counter() - self._start
+            self._ended = True
+
+            with self._collect():
+                self.parent_logger._log(
+                    self.id,
+                    level,
+                    message,
+                    stage=self.stage,
+                    tags=self._tags(tags),
+                    duration=duration,
+                    status=status,
+                )
+            self.flush()
+            # anything logged after the stage ended is written right away
+            self._pending = None
+
+        def _tags(self, tags):
+            return self.tags + tuple(tags) if tags else self.tags
+
+        def _collect(self):
+            return self.parent_logger._collect_into(self._pending)
+
+        def flush(self):
+            if self._pending:
+                pending = self._pending
+                self._pending = []
+                self.parent_logger._commit(pending)
 
         def failed(self, tags=[]):
-            self.parent_logger.error(
-                self.id, "Stage failed", stage=self.stage, tags=self.tags + tags
-            )
+            self._end("ERROR", "Stage failed", "failed", tags)
 
         def success(self, tags=[]):
-            self.parent_logger.info(
-                self.id, "Stage succeeded", stage=self.stage, tags=self.tags + tags
-            )
+            self._end("INFO", "Stage succeeded", "success", tags)
 
         # Wrapping parent logger functions within Stage class
         def debug(self, *messages, tags=[]):
-            self.parent_logger.debug(
-                self.id, *messages, stage=self.stage, tags=self.tags + tags
-            )
+            with self._collect():
+                self.parent_logger.debug(
+                    self.id, *messages, stage=self.stage, tags=self._tags(tags)
+                )
 
         def info(self, *messages, tags=[]):
-            self.parent_logger.info(
-                self.id, *messages, stage=self.stage, tags=self.tags + tags
-            )
+            with self._collect():
+                self.parent_logger.info(
+                    self.id, *messages, stage=self.stage, tags=self._tags(tags)
+                )
 
         def warning(self, *messages, tags=[]):
-            self.parent_logger.warning(
-                self.id, *messages, stage=self.stage, tags=self.tags + tags
-            )
+            with self._collect():
+                self.parent_logger.warning(
+                    self.id, *messages, stage=self.stage, tags=self._tags(tags)
+                )
 
         def error(self, *messages, tags=[]):
-            self.parent_logger.error(
-                self.id, *messages, stage=self.stage, tags=self.tags + tags
-            )
+            with self._collect():
+                self.parent_logger.error(
+                    self.id, *messages, stage=self.stage, tags=self._tags(tags)
+                )
 
         def exception(self, *messages, tags=[]):
-            self.parent_logger.exception(
-                self.id, *messages, stage=self.stage, tags=self.tags + tags
-            )
+            with self._collect():
+                self.parent_logger.exception(
+                    self.id, *messages, stage=self.stage, tags=self._tags(tags)
+                )
 
         def key_value(self, key, value, name=None, tags=[]):
-            self.parent_logger.key_value(
-                self.id, key, value, name=name, stage=self.stage, tags=self.tags + tags
+            with self._collect():
+                self.parent_logger.key_value(
+                    self.id,
+                    key,
+                    value,
+                    name=name,
+                    stage=self.stage,
+                    tags=self._tags(tags),
+                )
+
+        def counter(self, key, value=1, tags=[]):
+            self.parent_logger.counter(
+                key, value, stage=self.stage, tags=self._tags(tags)
+            )
+
+        def gauge(self, key, value, tags=[]):
+            self.parent_logger.gauge(key, value, stage=self.stage, tags=self._tags(tags))
+
+        def histogram(self, key, value, tags=[]):
+            self.parent_logger.histogram(
+                key, value, stage=self.stage, tags=self._tags(tags)
             )
 
 
@@ -350,5 +1525,71 @@ if __name__ == "__main__":
         for _ in range(100):
             create_some_log(logger)
 
+    elif sys.argv[1] == "bench_wire":
+        # bytes per record and decode time of the columns wire format vs pickle
+        import pickle
+
+        n_records = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+        u_ids = [str(uuid.uuid4()) for _ in range(n_records // 12 + 1)]
+
+        logs = {
+            str(uuid.uuid4()): {
+                "u_id": random.choice(u_ids),
+                "stage": random.choice(["preprocessing", "inference", "postprocessing"]),
+                "level": random.choice(["INFO", "DEBUG", "ERROR"]),
+                "messages": ["Stage started"],
+                "time": time.time(),
+                "tags": [f"tag.{random.randint(0, 10)}"],
+                "app_name": "analytics",
+            }
+            for _ in range(n_records)
+        }
+
+        def bench(name, dumps, loads, n_runs=20):
+            body = dumps(logs)
+
+            start = time.time()
+            for _ in range(n_runs):
+                assert len(loads(body)) == n_records
+            decode_ms = (time.time() - start) / n_runs * 1000
+
+            print(
+                f"{name}: {len(body) / n_records:.1f} bytes/record, {decode_ms:.2f} ms to decode {n_records} records"
+            )
+
+        bench(
+            "pickle",
+            lambda records: pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL),
+            pickle.loads,
+        )
+        bench("columns+gzip", dumps_batch, loads_batch)
+
+    elif sys.argv[1] == "bench_log":
+        # logging calls per second of a stage, async mode measures the caller's hot path only
+        import tempfile
+
+        n_calls = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+        for async_mode in (True, False):
+            logger = SmartLogger(
+                "bench",
+                dir=tempfile.mkdtemp(),
+                async_mode=async_mode,
+                buffer_size=n_calls * 2,
+            )
+            # sync mode commits every call, a smaller run is enough
+            calls = n_calls if async_mode else n_calls // 20
+            stage = logger.Stage("u_id", "inference", tags=["model:a"])
+
+            start = time.perf_counter()
+            for i in range(calls):
+                stage.debug("step", i, tags=["step"])
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{'async' if async_mode else 'sync'}: {calls / elapsed:,.0f} logging calls/sec"
+            )
+            logger.flush()
+
     else:
         upload_to_smartdash()